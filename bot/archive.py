@@ -0,0 +1,55 @@
+'''
+Append-only local archive of old database records, so the collections the bot and
+the stats pages use stay small.
+
+Records are stored as gzipped JSON lines (in MongoDB extended JSON, like the
+journal), in one file per collection per month of their timestamp. Every append
+adds a gzip member to the end of the file, so files are never rewritten, and
+`zcat` reads them as one.
+'''
+import gzip
+import logging
+import os
+import threading
+
+from bson import json_util
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+class Archive:
+    def __init__(self, directory):
+        self.directory = directory
+        self.written = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, collection, timestamp):
+        return os.path.join(self.directory, "{}-{:%Y-%m}.jsonl.gz".format(collection, timestamp))
+
+    def append(self, collection, records):
+        '''
+        Add records (with datetime timestamps) of the named collection to the archive,
+        and make sure they're on disk.
+        '''
+        files = {}
+        for record in records:
+            files.setdefault(self.path(collection, record['timestamp']), []).append(record)
+        with self._lock:
+            for path, batch in files.items():
+                with open(path, "ab") as archive:
+                    with gzip.GzipFile(fileobj=archive, mode="ab") as compressed:
+                        compressed.write("".join(json_util.dumps(record) + "\n" for record in batch).encode("utf-8"))
+                    archive.flush()
+                    os.fsync(archive.fileno())
+            self.written += len(records)
+
+    def read(self, collection):
+        '''
+        All archived records of the named collection, oldest month first.
+        '''
+        prefix = collection + "-"
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(prefix) and name.endswith(".jsonl.gz"):
+                with gzip.open(os.path.join(self.directory, name), "rt", encoding="utf-8") as archive:
+                    for line in archive:
+                        yield json_util.loads(line)
@@ -0,0 +1,281 @@
+'''
+Benchmarks for the hot paths of the modlinker; parsing comments, scraping workshop
+pages, formatting results and packing them into posts. Everything runs on the
+recorded fixtures (or generated inputs), so nothing touches reddit, steam or the
+database, and results are comparable between runs.
+
+Each benchmark times every call separately, and reports throughput and p50/p99
+latency. Results can be saved as JSON, and compared against a saved baseline;
+a benchmark whose p50 got more than `--tolerance` slower is flagged as a
+regression, and the run exits with a non-zero status.
+
+    python bench.py --save baseline.json           # on the old code
+    python bench.py --baseline baseline.json       # on the new code
+    python bench.py --filter parse --time 0.2      # just the parser, quickly
+'''
+# pylint: disable=wrong-import-position
+import os
+
+# common reads its settings from the environment, none of which matter here.
+for _key, _value in {"RIMWORLD_CURRENT_ALPHA": "1.0", "REDDIT_USER": "bench", "REDDIT_PASSWORD": "",
+                     "REDDIT_CLIENT_ID": "", "REDDIT_CLIENT_SECRET": "", "REDDIT_LISTEN_TO": "bench",
+                     "STEAM_KEY": "", "MONGO_URI": "mongodb://localhost/"}.items():
+    os.environ.setdefault(_key, _value)
+
+import argparse
+import glob
+import json
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+import extractors
+import formatting
+from commands import ModRequest
+from mod import Mod
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+BENCHMARKS = []
+
+def benchmark(name):
+    '''
+    Register a benchmark. The decorated function sets it up, and returns the
+    function to time and a list of inputs to call it with (one at a time, round robin),
+    and optionally a dict of other figures to report.
+    '''
+    def _register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return _register
+
+def _commands():
+    with open(os.path.join(FIXTURES, "commands.txt"), encoding="utf-8") as examples:
+        return [line.rstrip("\n") for line in examples if line.strip()]
+
+def _pages():
+    pages = []
+    for path in sorted(glob.glob(os.path.join(extractors.FIXTURES, "*.html"))):
+        with open(path, "rb") as page:
+            pages.append(page.read())
+    return pages
+
+def _mods():
+    request = ModRequest(True, "bench", "1.0", 10)
+    return [Mod(item, request) for page in _pages() for item in extractors.scrape_regex(page)]
+
+_WORDS = ("the colony raiders pawn mod mods scenario link there are some a for that with my of "
+          "expanded better more vanilla hospitality prosthetics manager tab work hud").split()
+
+def _prose(rng, length):
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(rng.choice(_WORDS))
+        if rng.random() < 0.05:
+            words[-1] += rng.choice(".,!?\n")
+    return " ".join(words)
+
+def _adversarial(rng):
+    '''
+    Comments that are hard on the parser; lots of triggers that don't lead anywhere,
+    very long queries, and walls of text with many commands in them.
+    '''
+    commands = _commands()
+    return [
+        "link " * 4000,
+        "linklinklink" * 2000,
+        "there are " * 2000 + "mods",
+        "link mod: " + "a" * 20000,
+        "link 10 mods: " + " ".join(_WORDS) * 200,
+        "link [" * 3000,
+        "link mod " + " " * 20000 + ":",
+        "\n".join(rng.choice(commands) for _ in range(300)),
+        _prose(rng, 10000),
+        "".join(rng.choice(["link", "there", " ", ":", "mod", "s", "1.0", "[", "]", "\n"]) for _ in range(5000)),
+    ]
+
+@benchmark("parse/commands")
+def _parse_commands():
+    return ModRequest.fromPost, _commands()
+
+@benchmark("parse/comments")
+def _parse_comments():
+    # comments of typical length, the vast majority of which don't ask for anything
+    rng = random.Random(1)
+    commands = _commands()
+    posts = [_prose(rng, rng.choice([80, 200, 500, 1500])) for _ in range(200)]
+    posts += [_prose(rng, 200) + "\n\n" + rng.choice(commands) for _ in range(20)]
+    return ModRequest.fromPost, posts
+
+@benchmark("parse/adversarial")
+def _parse_adversarial():
+    return ModRequest.fromPost, _adversarial(random.Random(2))
+
+def _scrape(backend):
+    def _setup():
+        return extractors.BACKENDS[backend], _pages()
+    return _setup
+
+for _backend in sorted(extractors.BACKENDS):
+    benchmark("scrape/" + _backend)(_scrape(_backend))
+
+def _items(count, rng):
+    # fresh strings for every item, like we get from scraping; a few authors post most mods
+    authors = ["author {}".format(index) for index in range(count // 20 + 1)]
+    items = []
+    for index in range(count):
+        author = "".join(list(rng.choice(authors)))
+        items.append({"title": "Some mod title number {} [1.0]".format(index) if index % 4 == 0 else "Some mod title number {}".format(index),
+                      "url": "https://steamcommunity.com/sharedfiles/filedetails/?id={}".format(1000000000 + index),
+                      "author": author,
+                      "profile": "https://steamcommunity.com/id/" + author.replace(" ", "")})
+    return items
+
+def _bytes_per_mod(count=10000):
+    # memory held by cached mods, strings included, once the scraped items are gone
+    request = ModRequest(True, "bench", "1.0", 10)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    mods = [Mod(item, request) for item in _items(count, random.Random(4))]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return round(used / len(mods))
+
+@benchmark("mod/create")
+def _mod_create():
+    request = ModRequest(True, "bench", "1.0", 10)
+    return (lambda item: Mod(item, request)), _items(1000, random.Random(5)), {"bytes_per_mod": _bytes_per_mod()}
+
+@benchmark("format/mod")
+def _format_mod():
+    mods = _mods()
+    return (lambda mod: (formatting.formatMod(mod, False), formatting.formatMod(mod, True))), mods
+
+@benchmark("format/results")
+def _format_results():
+    mods = _mods()
+    rng = random.Random(3)
+    cases = []
+    for count in (0, 1, 3, 10):
+        request = ModRequest(True, rng.choice(_WORDS), "1.0", count)
+        cases.append((request, mods[:count]))
+    return (lambda case: formatting.formatResults(*case)), cases
+
+def _posts(count, packing):
+    def _setup():
+        mods = _mods()
+        rng = random.Random(count)
+        parts = []
+        for _ in range(count):
+            request = ModRequest(True, rng.choice(_WORDS), "1.0", rng.randint(1, 10))
+            parts.append(formatting.formatResults(request, rng.sample(mods, request.count)))
+        # fewer replies means fewer rate limited calls to reddit; the lower bound is all parts back to back
+        replies = len(formatting.createPosts(deque(parts), packing))
+        bound = -(-sum(len(part) + 2 for part in parts) // (formatting.MAX_LENGTH - len(formatting.FOOTER)))
+        return (lambda parts: formatting.createPosts(deque(parts), packing)), [parts], {"replies": replies, "min_replies": bound}
+    return _setup
+
+for _count in (10, 100, 1000):
+    for _packing in ("greedy", "ffd", "ffd-stable"):
+        benchmark("posts/{}/{}".format(_count, _packing))(_posts(_count, _packing))
+
+def measure(func, inputs, min_time=1.0, min_calls=20, warmup=3):
+    '''
+    Call `func` on the inputs (round robin) for at least `min_time` seconds and
+    `min_calls` calls, timing each call.
+        :returns: dict of results
+    '''
+    for value in inputs[:warmup]:
+        func(value)
+
+    timings = []
+    total = 0
+    index = 0
+    while total < min_time or len(timings) < min_calls:
+        value = inputs[index % len(inputs)]
+        start = time.perf_counter()
+        func(value)
+        elapsed = time.perf_counter() - start
+        timings.append(elapsed)
+        total += elapsed
+        index += 1
+
+    timings.sort()
+    return {
+        "calls": len(timings),
+        "ops": len(timings) / total,
+        "mean_us": total / len(timings) * 1e6,
+        "p50_us": _percentile(timings, 50) * 1e6,
+        "p99_us": _percentile(timings, 99) * 1e6,
+        "max_us": timings[-1] * 1e6
+    }
+
+def _percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+def run(pattern=None, min_time=1.0):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if pattern and not re.search(pattern, name):
+            continue
+        func, inputs, *info = setup()
+        results[name] = measure(func, inputs, min_time)
+        print("{:<24} {ops:>12,.0f} ops/s  p50 {p50_us:>10,.1f}us  p99 {p99_us:>10,.1f}us".format(name, **results[name]), end="")
+        for figures in info:
+            results[name].update(figures)
+            print("  " + ", ".join("{} {}".format(key, value) for key, value in figures.items()), end="")
+        print()
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Compare p50 latencies against a baseline.
+        :returns: list of names of benchmarks that regressed
+    '''
+    regressions = []
+    print("\n{:<24} {:>12} {:>12} {:>8}".format("vs baseline", "p50 before", "p50 now", "change"))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print("{:<24} {:>12} {:>10,.1f}us {:>8}".format(name, "-", result['p50_us'], "new"))
+            continue
+        change = result['p50_us'] / before['p50_us'] - 1 if before['p50_us'] else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<24} {:>10,.1f}us {:>10,.1f}us {:>+7.0%}{}".format(name, before['p50_us'], result['p50_us'], change, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the modlinker's hot paths on recorded fixtures.")
+    parser.add_argument("--filter", help="only run benchmarks matching this regex")
+    parser.add_argument("--time", type=float, default=1.0, help="seconds to run each benchmark for (default: 1)")
+    parser.add_argument("--save", metavar="PATH", help="save results as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against results saved earlier")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="p50 slowdown flagged as a regression (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.time)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as output:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "results": results},
+                      output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as saved:
+            baseline = json.load(saved)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
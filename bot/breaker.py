@@ -0,0 +1,65 @@
+'''
+Circuit breaker, to stop hammering a service that is down.
+'''
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+class CircuitBreaker:
+    '''
+    Opens after `threshold` consecutive failures, and stays open for `cooldown`
+    seconds. After that it lets a single trial call through (half-open); if that
+    succeeds the breaker closes again, if it fails it re-opens.
+    '''
+    def __init__(self, name, threshold=3, cooldown=30.0):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.trips = 0
+        self._state = CLOSED
+        self._opened = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened >= self.cooldown:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        '''
+        Should we try to call the service? Returns True at most once per cooldown while open.
+        '''
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened >= self.cooldown:
+                self._state = HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                log.info("%s is back, closing circuit breaker", self.name)
+            self._state = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self.failures >= self.threshold):
+                if self._state == CLOSED:
+                    log.warning("%s failed %s times, opening circuit breaker for %ss",
+                                self.name, self.failures, self.cooldown)
+                    self.trips += 1
+                self._state = OPEN
+                self._opened = time.monotonic()
@@ -0,0 +1,165 @@
+'''
+In-process cache for workshop search results, keyed by normalized request.
+'''
+import logging
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+def normalize(text):
+    '''
+    Normalize a query for comparison; Unicode NFKC, case-folded and with all
+    runs of whitespace collapsed to a single space.
+    '''
+    text = unicodedata.normalize("NFKC", text or "")
+    return " ".join(text.casefold().split())
+
+def cache_key(request):
+    '''
+    Cache key for a ModRequest; the normalized query plus its tags.
+    '''
+    return (normalize(request.query), tuple(sorted(request.tags)))
+
+def sizeof_mod(mod):
+    '''
+    Rough estimate of the memory used by a Mod, in bytes. Authors, profiles and
+    alpha labels are shared between mods, so they don't count.
+    '''
+    return sys.getsizeof(mod) + sys.getsizeof(mod.title) + sys.getsizeof(mod.url)
+
+class _Entry:
+    __slots__ = ("mods", "complete", "expires", "size")
+
+    def __init__(self, mods, complete, expires, size):
+        self.mods = mods
+        self.complete = complete
+        self.expires = expires
+        self.size = size
+
+    def covers(self, count):
+        '''
+        Can this entry answer a request for `count` results? That is the case if we
+        have at least that many results, or if we got everything there was to get.
+        '''
+        return self.complete or len(self.mods) >= count
+
+class SearchCache:
+    '''
+    Bounded LRU cache of search results, with a per-entry TTL. Empty results are
+    cached as well, but with a (much) shorter TTL. The cache is bounded both by
+    the number of entries, and by the estimated memory size of the cached mods.
+
+    Expired entries are kept for another `stale` seconds, so that they can still be
+    served with `get_stale` when we can't get fresh results.
+    '''
+    def __init__(self, max_entries=2048, max_bytes=16*1024*1024, ttl=6*60*60, negative_ttl=5*60, stale=24*60*60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale = stale
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, request):
+        '''
+        Get cached mods for a ModRequest, or None if we don't have (enough of) them.
+        Note that the returned list may contain more mods than requested.
+        '''
+        key = cache_key(request)
+        with self._lock:
+            entry = self._live(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                entry = None
+            if entry is None or not entry.covers(request.count):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.mods
+
+    def get_stale(self, request):
+        '''
+        Get cached mods for a ModRequest even if they have expired (within the stale window),
+        or None if we don't have any. Might have fewer mods than requested.
+        '''
+        key = cache_key(request)
+        with self._lock:
+            entry = self._live(key)
+            if entry is None or not entry.mods:
+                return None
+            self.stale_hits += 1
+            return entry.mods
+
+    def _live(self, key):
+        # the entry for key, unless it's past its stale window
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires + self.stale <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def put(self, request, mods, complete=False, ttl=None):
+        '''
+        Cache the results for a ModRequest.
+            :param mods: list of Mod
+            :param complete: True if `mods` holds all the results there are for this query
+            :param ttl: seconds to keep them for, if not the default (e.g. when they came from another cache)
+        '''
+        key = cache_key(request)
+        mods = list(mods)
+        if ttl is None:
+            ttl = self.ttl if mods else self.negative_ttl
+        entry = _Entry(mods, complete or not mods, time.monotonic() + ttl, sum(sizeof_mod(mod) for mod in mods))
+        if entry.size > self.max_bytes:
+            return
+
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None:
+                # don't replace a live entry that can answer more than the new one
+                if (current.expires > time.monotonic()
+                        and not entry.complete
+                        and (current.complete or len(current.mods) > len(mods))):
+                    self._entries.move_to_end(key)
+                    return
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,96 @@
+'''
+Persistent checkpoint of the comment stream, so a restart doesn't re-handle
+comments we've already dealt with.
+'''
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+def _number(comment_id):
+    # reddit ids are base 36 and increase over time
+    return int(comment_id, 36)
+
+class Checkpoint:
+    '''
+    Tracks the newest comment that has been fully handled, such that every comment
+    before it has been handled as well. Comments are handled concurrently and can
+    finish out of order, so the checkpoint only moves past a comment once it and
+    all comments before it are done.
+    '''
+    def __init__(self, path, save_interval=5.0):
+        self.path = path
+        self.save_interval = save_interval
+        self.id = None
+        self.created = 0.0
+        self._inflight = {}
+        self._saved = 0.0
+        self._dirty = False
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def seen(self, comment):
+        '''
+        Is this comment at or before the checkpoint, or already being handled?
+        '''
+        if comment.id in self._inflight:
+            return True
+        return self.id is not None and _number(comment.id) <= _number(self.id)
+
+    def begin(self, comment):
+        with self._lock:
+            self._inflight.setdefault(comment.id, [_number(comment.id), comment.created_utc, False])
+
+    def done(self, comment):
+        with self._lock:
+            entry = self._inflight.get(comment.id)
+            if entry is None:
+                return
+            entry[2] = True
+
+            # move the checkpoint up to the oldest comment we're still working on
+            while self._inflight:
+                oldest = min(self._inflight, key=lambda key: self._inflight[key][0])
+                number, created, finished = self._inflight[oldest]
+                if not finished:
+                    break
+                del self._inflight[oldest]
+                if self.id is None or number > _number(self.id):
+                    self.id = oldest
+                    self.created = created
+                    self._dirty = True
+
+        if self._dirty and time.monotonic() - self._saved >= self.save_interval:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            state = {"id": self.id, "created": self.created}
+            self._dirty = False
+            self._saved = time.monotonic()
+        temp = self.path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as checkpoint:
+            json.dump(state, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temp, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as checkpoint:
+                state = json.load(checkpoint)
+            self.id = state['id']
+            self.created = state['created']
+            log.info("resuming after comment %s (%.0fs ago)", self.id, time.time() - self.created)
+        except FileNotFoundError:
+            log.info("no checkpoint found, starting from scratch")
+        except (ValueError, KeyError) as err:
+            log.warning("ignoring unreadable checkpoint %s: %s", self.path, err)
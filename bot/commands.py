@@ -31,6 +31,33 @@ REGEXES_MULTIPLE = [
     # note that lists are extracted as a block, and further split up in the ModRequest factories.
 ]
 
+# The same patterns, without the leading lazy `.*?`. All of them start with either `link`
+# or `there`, so instead of letting every pattern crawl over every position in the post, we
+# find those trigger words once, and only try the patterns there. See `scan`.
+_TRIGGER = re.compile(r"link|there", _regexFlags)
+_SCANNERS = [re.compile(regex.pattern[len(".*?"):], regex.flags) for regex in REGEXES_SINGLE + REGEXES_MULTIPLE]
+
+def scan(post):
+    '''
+    Find all command matches in a post, in a single pass over its trigger words.
+    Posts without triggers (nearly all of them) are rejected by the first search.
+        :returns: lists of matches for each pattern in REGEXES_SINGLE + REGEXES_MULTIPLE,
+                  identical to what `finditer` would give for each of those.
+    '''
+    matches = [[] for _ in _SCANNERS]
+    ends = [0 for _ in _SCANNERS]
+    for trigger in _TRIGGER.finditer(post):
+        pos = trigger.start()
+        for index, scanner in enumerate(_SCANNERS):
+            # matches of the same pattern don't overlap
+            if pos < ends[index]:
+                continue
+            match = scanner.match(post, pos)
+            if match:
+                matches[index].append(match)
+                ends[index] = match.end()
+    return matches
+
 def getTag(alpha = None, version = None):
     if version:
         return version
@@ -79,15 +106,22 @@ class ModRequest:
 
     @classmethod
     def fromPost(cls, post):
+        return cls.fromMatches(scan(post))
+
+    @classmethod
+    def fromMatches(cls, matches):
+        '''
+        Create requests from lists of matches for each of REGEXES_SINGLE + REGEXES_MULTIPLE.
+        '''
         requests = []
 
-        for regex in REGEXES_SINGLE:
-            for match in regex.finditer(post):
+        for pattern in matches[:len(REGEXES_SINGLE)]:
+            for match in pattern:
                 data = match.groupdict()
                 requests.append(ModRequest(data['type'].lower() == "mod", data['query'], getTag(data['alpha'], data['version']), 1))
 
-        for regex in REGEXES_MULTIPLE:
-            for match in regex.finditer( post ):
+        for pattern in matches[len(REGEXES_SINGLE):]:
+            for match in pattern:
                 data = match.groupdict()
                 queries = re.split(r',', data['query'])
                 count = 1
@@ -103,3 +137,36 @@ class ModRequest:
 
     def __str__(self):
         return "Request for {!s} [{!s}] matching {!s}".format(self.count, ", ".join(self.tags), self.query)
+
+
+if __name__ == '__main__':
+    # differential check of the single-pass scanner against plain `finditer` over each of the regexes,
+    # on the example commands and on random (and partly hostile) combinations of command fragments.
+    import os
+    import random
+    import sys
+
+    def reference(post):
+        return ModRequest.fromMatches([list(regex.finditer(post)) for regex in REGEXES_SINGLE + REGEXES_MULTIPLE])
+
+    fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "commands.txt")
+    with open(fixture, encoding="utf-8") as examples:
+        posts = [line.rstrip("\n") for line in examples]
+    posts.append("\n".join(posts))
+
+    fragments = ["link", "LINK", "there's", "there are", "there", " ", "  ", "\n", "\t", ":", ",", ".", ";", ")", "(",
+                 "mod", "mods", "Mod", "scenario", "scenarios", "s", "for that", "for", "that", "a", "an", "4", "20",
+                 "A17", "[B18]", "alpha 16", "beta", "v1.0", "1.0", "version", "Colony Manager", "ȧƈƈḗƞŧ", "linklink"]
+    rng = random.Random(294100)
+    for _ in range(20000):
+        posts.append("".join(rng.choice(fragments) for _ in range(rng.randint(1, 30))))
+
+    failures = 0
+    for post in posts:
+        expected = [vars(request) for request in reference(post)]
+        actual = [vars(request) for request in ModRequest.fromPost(post)]
+        if actual != expected:
+            failures += 1
+            print("MISMATCH for {!r}:\n\texpected {}\n\tgot {}".format(post, expected, actual))
+    print("{} posts checked, {} mismatches".format(len(posts), failures))
+    sys.exit(1 if failures else 0)
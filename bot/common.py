@@ -1,7 +1,7 @@
 '''
 Common variables for the modlinker.
 '''
-from os import environ
+from os import environ, path
 
 # configuration
 MAX_RESULTS = 10
@@ -9,6 +9,159 @@ MAX_LENGTH = 9900 # real max is 10000, leave a bit of wiggle room
 # TODO: Dynamically get the current alpha number
 CURRENT_VERSION = environ['RIMWORLD_CURRENT_ALPHA'] # default tag for the current alpha
 EPSILON = 1/1000
+DATA_DIR = environ.get('MODLINKER_DATA', 'data') # local state; journals, indexes, checkpoints
+SEARCH_WORKERS = int(environ.get('MODLINKER_SEARCH_WORKERS', 4)) # max concurrent workshop searches
+SCRAPER = environ.get('MODLINKER_SCRAPER', 'auto') # workshop html extraction backend; auto, regex, lxml or soup
+PACKING = environ.get('MODLINKER_PACKING', 'greedy') # how to spread results over replies; greedy, ffd or ffd-stable, see formatting.createPosts
+STREAM_FETCH = environ.get('MODLINKER_STREAM_FETCH', 'yes').lower() in ('1', 'true', 'yes') # stop downloading once we have enough results
+
+# worker stages of the main loop, see modlinker
+PIPELINE = {
+    "search_workers": int(environ.get('MODLINKER_SEARCH_STAGE_WORKERS', 2)), # comments searched for concurrently
+    "reply_workers": int(environ.get('MODLINKER_REPLY_STAGE_WORKERS', 1)),
+    "analytics_workers": int(environ.get('MODLINKER_ANALYTICS_STAGE_WORKERS', 1)),
+    "queue_size": int(environ.get('MODLINKER_STAGE_QUEUE_SIZE', 50)), # jobs waiting per stage before we stop reading comments
+    "report_interval": float(environ.get('MODLINKER_STAGE_REPORT_INTERVAL', 300)), # seconds between stats in the log, 0 to disable
+    "drain_timeout": float(environ.get('MODLINKER_DRAIN_TIMEOUT', 60)) # seconds per stage when shutting down
+}
+
+# reply rate limiting, see scheduler
+REPLY = {
+    "per_minute": float(environ.get('MODLINKER_REPLY_RATE', 0)), # replies per minute we allow ourselves, 0 to only back off when reddit tells us to
+    "burst": int(environ.get('MODLINKER_REPLY_BURST', 10)), # replies we may post back to back
+    "default_wait": float(environ.get('MODLINKER_RATELIMIT_WAIT', 60)) # seconds to back off when reddit doesn't say how long
+}
+
+# local index of comments we've replied to, see replied
+REPLIED = {
+    "horizon": float(environ.get('MODLINKER_REPLIED_HORIZON', 7*24*60*60)), # seconds to remember replies for
+    "refresh": environ.get('MODLINKER_REPLIED_REFRESH', 'yes').lower() in ('1', 'true', 'yes') # ask reddit about older comments
+}
+
+# stream checkpoint, see checkpoint
+CHECKPOINT = {
+    "save_interval": float(environ.get('MODLINKER_CHECKPOINT_INTERVAL', 5)), # seconds between checkpoint writes
+    "catchup_window": float(environ.get('MODLINKER_CATCHUP_WINDOW', 60*60)), # seconds; missed comments older than this are skipped, 0 to disable catch-up
+    "catchup_limit": int(environ.get('MODLINKER_CATCHUP_LIMIT', 100)) # most recent comments to look at when catching up
+}
+
+# search result cache settings
+CACHE = {
+    "max_entries": int(environ.get('MODLINKER_CACHE_ENTRIES', 2048)),
+    "max_bytes": int(environ.get('MODLINKER_CACHE_BYTES', 16*1024*1024)),
+    "ttl": float(environ.get('MODLINKER_CACHE_TTL', 6*60*60)), # seconds
+    "negative_ttl": float(environ.get('MODLINKER_CACHE_NEGATIVE_TTL', 5*60)), # seconds, for searches without results
+    "stale": float(environ.get('MODLINKER_CACHE_STALE', 24*60*60)) # seconds past the ttl we may still serve results while steam is down
+}
+
+# search results cache on disk shared between worker processes, see shared_cache and supervisor
+SHARED_CACHE = environ.get('MODLINKER_SHARED_CACHE', '') # path of the sqlite database, empty to disable
+
+# this worker handles comments whose id modulo count is index, see supervisor
+SHARD = tuple(int(part) for part in environ.get('MODLINKER_SHARD', '0/1').split('/')) # index/count
+# chores one worker can do for all of them; crawling the workshop index, creating database indexes, archiving old records
+MAINTENANCE = environ.get('MODLINKER_MAINTENANCE', 'yes').lower() in ('1', 'true', 'yes')
+
+# running several workers under a supervisor, see supervisor
+SUPERVISOR = {
+    "workers": int(environ.get('MODLINKER_WORKERS', 2)),
+    "partition": environ.get('MODLINKER_PARTITION', 'subreddit'), # subreddit: split the subreddits between workers, hash: split comments by id
+    "report_interval": float(environ.get('MODLINKER_SUPERVISOR_REPORT_INTERVAL', 5*60)), # seconds between throughput reports
+    "restart_delay": float(environ.get('MODLINKER_RESTART_DELAY', 5)), # seconds, doubled for every crash in a row
+    "max_restart_delay": float(environ.get('MODLINKER_MAX_RESTART_DELAY', 5*60)), # seconds
+    "stable": float(environ.get('MODLINKER_STABLE_AFTER', 10*60)) # seconds a worker has to stay up for its crashes to be forgotten
+}
+
+# backing off from steam when it struggles, see limiter
+STEAM_LIMITS = {
+    "initial": int(environ.get('MODLINKER_STEAM_CONCURRENCY', max(SEARCH_WORKERS, 1))), # concurrent workshop fetches to start with
+    "minimum": 1,
+    "maximum": max(SEARCH_WORKERS, 1),
+    "target_latency": float(environ.get('MODLINKER_STEAM_TARGET_LATENCY', 3)), # seconds; slower fetches make us back off
+    "acquire_timeout": float(environ.get('MODLINKER_STEAM_QUEUE_TIMEOUT', 30)), # seconds to wait for a turn before giving up
+    "breaker": {
+        "threshold": int(environ.get('MODLINKER_STEAM_BREAKER_THRESHOLD', 5)), # consecutive failures before we stop trying
+        "cooldown": float(environ.get('MODLINKER_STEAM_BREAKER_COOLDOWN', 60)) # seconds before we try again
+    }
+}
+
+# searches that couldn't be done because steam is unavailable are retried later
+SEARCH_RETRY = {
+    "attempts": int(environ.get('MODLINKER_SEARCH_RETRIES', 6)),
+    "delay": float(environ.get('MODLINKER_SEARCH_RETRY_DELAY', 30)), # seconds, doubled for each attempt
+    "max_delay": float(environ.get('MODLINKER_SEARCH_RETRY_MAX_DELAY', 15*60)) # seconds
+}
+
+# http settings for workshop requests
+HTTP = {
+    "connect_timeout": float(environ.get('MODLINKER_HTTP_CONNECT_TIMEOUT', 3.05)), # seconds
+    "read_timeout": float(environ.get('MODLINKER_HTTP_READ_TIMEOUT', 10)), # seconds
+    "retries": int(environ.get('MODLINKER_HTTP_RETRIES', 3)),
+    "backoff": float(environ.get('MODLINKER_HTTP_BACKOFF', 0.5)), # seconds, doubled for each retry
+    "pool_hosts": 4, # number of hosts to keep connection pools for
+    "pool_size": int(environ.get('MODLINKER_HTTP_POOL_SIZE', max(SEARCH_WORKERS, 1))), # connections per host
+    "chunk_size": 8*1024 # bytes, when streaming responses
+}
+
+# database settings
+DATABASE = {
+    "timeout_ms": int(environ.get('MODLINKER_DB_TIMEOUT_MS', 5000)), # server selection/connection timeout
+    "buffer": {
+        "batch_size": int(environ.get('MODLINKER_DB_BATCH_SIZE', 500)), # records per insert
+        "max_age": float(environ.get('MODLINKER_DB_FLUSH_INTERVAL', 5)), # seconds a record may wait before being written
+        "max_records": int(environ.get('MODLINKER_DB_MAX_BUFFERED', 50000)), # records kept in memory before we start dropping them
+        "replay_interval": float(environ.get('MODLINKER_DB_REPLAY_INTERVAL', 30)) # seconds between journal replay attempts
+    },
+    "breaker": {
+        "threshold": int(environ.get('MODLINKER_DB_BREAKER_THRESHOLD', 2)), # consecutive failures before we stop trying
+        "cooldown": float(environ.get('MODLINKER_DB_BREAKER_COOLDOWN', 60)) # seconds before we try again
+    },
+    "journal": {
+        "max_bytes": int(environ.get('MODLINKER_DB_JOURNAL_SEGMENT', 8*1024*1024)) # bytes per journal file
+    },
+    "migrate_batch_size": int(environ.get('MODLINKER_DB_MIGRATE_BATCH', 1000)), # records per batch when converting timestamps
+    "archive": {
+        "max_age": float(environ.get('MODLINKER_DB_ARCHIVE_AFTER_DAYS', 365)) * 24*60*60, # seconds before raw records are moved out of the database
+        "directory": environ.get('MODLINKER_DB_ARCHIVE_DIR', path.join(DATA_DIR, "archive")),
+        "batch_size": int(environ.get('MODLINKER_DB_ARCHIVE_BATCH', 1000)),
+        "interval": float(environ.get('MODLINKER_DB_ARCHIVE_INTERVAL', 24*60*60)) # seconds between archive runs, 0 to only archive by hand
+    }
+}
+
+# offline workshop index, see workshop_index
+INDEX = {
+    "enabled": environ.get('MODLINKER_INDEX', 'no').lower() in ('1', 'true', 'yes'),
+    "path": environ.get('MODLINKER_INDEX_PATH', path.join(DATA_DIR, "workshop_index.json.gz")),
+    "max_age": float(environ.get('MODLINKER_INDEX_MAX_AGE', 2*24*60*60)), # seconds since the last complete crawl before we stop trusting the index
+    "crawl_interval": float(environ.get('MODLINKER_INDEX_CRAWL_INTERVAL', 6*60*60)), # seconds
+    "pages": int(environ.get('MODLINKER_INDEX_PAGES', 100)), # max browse pages per set of tags per crawl
+    "versions": [version for version in environ.get('MODLINKER_INDEX_VERSIONS', '').split(',') if version] # defaults to the current version
+}
+
+# fuzzy matching of misspelled titles when a search has no results, see fuzzy
+FUZZY = {
+    "enabled": environ.get('MODLINKER_FUZZY', 'yes').lower() in ('1', 'true', 'yes'),
+    "threshold": float(environ.get('MODLINKER_FUZZY_THRESHOLD', 0.7)), # minimum similarity (0-1) to use a correction
+    "seed": environ.get('MODLINKER_FUZZY_SEED', 'yes').lower() in ('1', 'true', 'yes') # learn titles from past requests at startup
+}
+
+# metrics, see metrics
+METRICS = {
+    "port": int(environ.get('MODLINKER_METRICS_PORT', 0)), # serve prometheus metrics on this port, 0 to disable
+    "host": environ.get('MODLINKER_METRICS_HOST', '127.0.0.1'),
+    "report_interval": float(environ.get('MODLINKER_METRICS_REPORT_INTERVAL', 15*60)), # seconds between summaries in the log, 0 to disable
+    "snapshot": environ.get('MODLINKER_METRICS_SNAPSHOT', ''), # write the metrics to this file every so often, for the supervisor
+    "snapshot_interval": float(environ.get('MODLINKER_METRICS_SNAPSHOT_INTERVAL', 10)) # seconds
+}
+
+# on demand profiling, see profiling
+PROFILING = {
+    "directory": path.join(DATA_DIR, "profiles"),
+    "at_start": environ.get('MODLINKER_PROFILE', 'no').lower() in ('1', 'true', 'yes'), # profile right away, as well as on SIGUSR1
+    "comments": int(environ.get('MODLINKER_PROFILE_COMMENTS', 200)), # comments per profiling session, 0 for no limit
+    "seconds": float(environ.get('MODLINKER_PROFILE_SECONDS', 300)), # max seconds per profiling session, 0 for no limit
+    "slow_threshold": float(environ.get('MODLINKER_SLOW_THRESHOLD', 30)) # log a breakdown of comments taking longer than this many seconds, 0 to disable
+}
 
 # reddit settings
 REDDIT = {
@@ -24,7 +177,7 @@ REDDIT = {
 STEAM = {
     "key": environ['STEAM_KEY'],
     "WORKSHOP": {
-        "search_url": 'http://steamcommunity.com/workshop/browse/?{params}',
+        "search_url": 'https://steamcommunity.com/workshop/browse/?{params}',
         "mod_url": 'https://steamcommunity.com/sharedfiles/filedetails/?id={id}',
         "PARAMS": {
             "appid": 294100,   
@@ -1,13 +1,43 @@
 '''
 Service module to handle database logging.
+
+Records are not written straight away, but queued in a write-behind buffer and
+inserted in batches by a background thread, so logging never blocks the bot.
+If the database is slow or down, a circuit breaker trips and records are spilled
+to a local journal instead, which is replayed in the background once it's back.
+
+Next to the raw records, we keep counters of requests per mod, author, redditor
+and day, so the stats pages can read the top N from a small indexed collection
+instead of aggregating every request ever made. Increments are coalesced in the
+buffer, and written with bulk upserts. `python database.py backfill` rebuilds the
+counters from the raw records.
+
+Records are timestamped with (UTC) datetimes. Older records have string timestamps,
+`python database.py migrate` converts those. `python database.py archive` moves raw
+records older than DATABASE['archive']['max_age'] out of the database, into local
+compressed files, see archive; best run every day or so, from a single process.
 '''
+import atexit
 import logging
 import os
 import datetime
-from pymongo import MongoClient
+import sys
+import threading
+import time
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import metrics
+from archive import Archive
+from breaker import CircuitBreaker, OPEN
+from common import DATA_DIR, DATABASE
+from journal import Journal
 
 LOG = logging.getLogger(__name__)
-CLIENT = MongoClient(os.environ['MONGO_URI'].strip("\""))
+CLIENT = MongoClient(os.environ['MONGO_URI'].strip("\""),
+                     serverSelectionTimeoutMS=DATABASE['timeout_ms'],
+                     connectTimeoutMS=DATABASE['timeout_ms'])
 DB = CLIENT.teddy
 
 # TODO: rename collections to be more sensible.
@@ -16,6 +46,310 @@ REQUESTS = DB.requests_collection
 PATTERNS = DB.patterns
 POSTS = DB.posts
 
+# pre-aggregated counters, see `count_mod`
+MOD_COUNTS = DB.counts_mods
+AUTHOR_COUNTS = DB.counts_authors
+REDDITOR_COUNTS = DB.counts_redditors
+DAILY_COUNTS = DB.counts_daily
+COUNTERS = (MOD_COUNTS, AUTHOR_COUNTS, REDDITOR_COUNTS, DAILY_COUNTS)
+RAW = (REQUESTS, PATTERNS, POSTS)
+
+# str(datetime.now()) leaves out the microseconds when there aren't any
+_STRING_TIMESTAMPS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S")
+_BSON_STRING = 2
+
+WRITE_SECONDS = metrics.histogram("modlinker_db_write_seconds", "Time per batch insert")
+WRITTEN = metrics.counter("modlinker_db_records_written_total", "Records written to the database")
+SPILLED = metrics.counter("modlinker_db_records_spilled_total", "Records spilled to the journal")
+INCREMENTED = metrics.counter("modlinker_db_counters_written_total", "Counter upserts written to the database")
+
+# error code for duplicate keys, which we get when replaying records that did make it in before.
+DUPLICATE_KEY = 11000
+
+class WriteBuffer:
+    '''
+    Write-behind buffer for database records. Records are flushed with unordered
+    `insert_many` calls once `batch_size` records are queued, or the oldest record
+    has waited `max_age` seconds. At most `max_records` records are kept in memory,
+    anything over that is dropped (and counted).
+
+    If a `breaker` and `journal` are given, records that can't be written (or that
+    we don't even try to write while the breaker is open) are spilled to the journal,
+    and the journal is replayed every `replay_interval` seconds while the breaker isn't open.
+
+    Counter increments are summed per document until they're flushed, along with the
+    records. Increments that can't be written are kept (they don't take more room
+    the longer we keep them) and retried with the next flush, rather than journaled.
+    '''
+    def __init__(self, database, batch_size=500, max_age=5.0, max_records=50000,
+                 breaker=None, journal=None, replay_interval=30.0):
+        self.database = database
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_records = max_records
+        self.breaker = breaker
+        self.journal = journal
+        self.replay_interval = replay_interval
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.incremented = 0
+        self._batches = {}
+        self._counters = {}
+        self._pending = 0
+        self._pending_counters = 0
+        self._oldest = None
+        self._closed = False
+        self._replay_pending = journal is not None and journal.pending()
+        self._last_replay = 0.0
+        self._cond = threading.Condition()
+        self._flushing = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="database-flush", daemon=True)
+        self._thread.start()
+
+    def put(self, record, collection):
+        with self._cond:
+            if self._pending >= self.max_records:
+                self.dropped += 1
+                return
+            self._batches.setdefault(collection.name, []).append(record)
+            self._pending += 1
+            self.queued += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif self._pending >= self.batch_size:
+                self._cond.notify()
+
+    def increment(self, collection, key, amount=1, fields=None):
+        '''
+        Add `amount` to the count of the document with id `key`, creating it if needed.
+            :param fields: other fields to set on the document
+        '''
+        with self._cond:
+            counters = self._counters.setdefault(collection.name, {})
+            if not self._merge(counters, key, amount, fields):
+                self.dropped += 1
+                return
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify()
+
+    def flush(self):
+        '''
+        Write out everything that is currently buffered.
+        '''
+        with self._flushing:
+            with self._cond:
+                batches, self._batches = self._batches, {}
+                counters, self._counters = self._counters, {}
+                self._pending = 0
+                self._pending_counters = 0
+                self._oldest = None
+            for collection, records in batches.items():
+                self._insert(collection, records)
+            for collection, increments in counters.items():
+                self._increment(collection, increments)
+
+    def replay(self):
+        '''
+        Replay the oldest segment of the journal.
+        '''
+        self._last_replay = time.monotonic()
+        try:
+            replayed = self.journal.replay(self._replay_insert, self.batch_size)
+            self.replayed += replayed
+            if replayed:
+                LOG.info("replayed %s records from the journal", replayed)
+        except Exception as err: # pylint: disable=W0703
+            LOG.error("%s while replaying journal: %s", type(err), err)
+        self._replay_pending = self.journal.pending()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        if self._pending_counters:
+            LOG.warning("%s counter updates could not be written, `python database.py backfill` to rebuild the counters",
+                        self._pending_counters)
+
+    def stats(self):
+        return {
+            "pending": self._pending,
+            "queued": self.queued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "quarantined": self.journal.quarantined if self.journal else 0,
+            "incremented": self.incremented,
+            "counters": self._pending_counters,
+            "breaker": self.breaker.state if self.breaker else None
+        }
+
+    def _insert(self, collection, records):
+        if self.breaker is not None and not self.breaker.allow():
+            self._spill(collection, records)
+            return
+        try:
+            with WRITE_SECONDS.time():
+                self.database[collection].insert_many(records, ordered=False)
+            self.flushed += len(records)
+            WRITTEN.inc(len(records))
+            self._healthy()
+        except BulkWriteError as err:
+            # the database is fine, some of the records aren't.
+            self._healthy()
+            inserted = err.details.get('nInserted', 0)
+            self.flushed += inserted
+            WRITTEN.inc(inserted)
+            self.failed += len(records) - inserted
+            LOG.error("%s in %s: %s of %s records not written.\n%s",
+                      type(err), collection, len(records) - inserted, len(records), err)
+        except Exception as err: # pylint: disable=W0703
+            LOG.error("%s in %s: %s records not written.\n%s", type(err), collection, len(records), err)
+            if self.breaker is not None:
+                self.breaker.failure()
+            self._spill(collection, records)
+
+    def _increment(self, collection, increments):
+        if self.breaker is not None and not self.breaker.allow():
+            self._requeue(collection, increments)
+            return
+        keys = list(increments)
+        operations = []
+        for key in keys:
+            amount, fields = increments[key]
+            update = {"$inc": {"count": amount}}
+            if fields:
+                update["$set"] = fields
+            operations.append(UpdateOne({"_id": key}, update, upsert=True))
+        try:
+            with WRITE_SECONDS.time():
+                self.database[collection].bulk_write(operations, ordered=False)
+            self.incremented += len(keys)
+            INCREMENTED.inc(len(keys))
+            self._healthy()
+        except BulkWriteError as err:
+            # e.g. two workers upserting the same new document at once; try those again later.
+            self._healthy()
+            failed = [keys[error['index']] for error in err.details.get('writeErrors', [])]
+            self.incremented += len(keys) - len(failed)
+            INCREMENTED.inc(len(keys) - len(failed))
+            LOG.warning("%s in %s: %s of %s counter updates not written, retrying later.",
+                        type(err), collection, len(failed), len(keys))
+            self._requeue(collection, {key: increments[key] for key in failed})
+        except Exception as err: # pylint: disable=W0703
+            LOG.error("%s in %s: %s counter updates not written, retrying later.\n%s", type(err), collection, len(keys), err)
+            if self.breaker is not None:
+                self.breaker.failure()
+            self._requeue(collection, increments)
+
+    def _requeue(self, collection, increments):
+        with self._cond:
+            counters = self._counters.setdefault(collection, {})
+            for key, (amount, fields) in increments.items():
+                if not self._merge(counters, key, amount, fields):
+                    self.dropped += 1
+            if counters and self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def _merge(self, counters, key, amount, fields):
+        # call with the lock held; add to the pending increment for key, or start a new one if there's room
+        current = counters.get(key)
+        if current is not None:
+            current[0] += amount
+            if fields:
+                current[1] = fields
+            return True
+        if self._pending_counters >= self.max_records:
+            return False
+        counters[key] = [amount, fields]
+        self._pending_counters += 1
+        return True
+
+    def _replay_insert(self, collection, records):
+        # returns the records the database refuses, for the journal to quarantine
+        rejected = []
+        try:
+            self.database[collection].insert_many(records, ordered=False)
+        except BulkWriteError as err:
+            # duplicates made it in before, anything else never will
+            errors = [error for error in err.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY]
+            rejected = [records[error['index']] for error in errors]
+            if errors:
+                LOG.warning("%s refused %s journal records: %s", collection, len(errors), errors[0].get('errmsg'))
+        except Exception:
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise
+        self._healthy()
+        return rejected
+
+    def _healthy(self):
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def _spill(self, collection, records):
+        if self.journal is None:
+            self.failed += len(records)
+            return
+        # give every record an id, so replaying twice can't create duplicates
+        for record in records:
+            record.setdefault('_id', ObjectId())
+        try:
+            self.journal.append(collection, records)
+            self.spilled += len(records)
+            SPILLED.inc(len(records))
+            self._replay_pending = True
+        except Exception as err: # pylint: disable=W0703
+            self.failed += len(records)
+            LOG.error("%s while spilling %s records to the journal: %s", type(err), len(records), err)
+
+    def _replay_due(self):
+        return (self._replay_pending
+                and time.monotonic() - self._last_replay >= self.replay_interval
+                and self.breaker is not None and self.breaker.state != OPEN)
+
+    def _flush_due(self):
+        # while the breaker is open counters are only put back, so a full batch of them can wait for max_age
+        counters_due = self._pending_counters >= self.batch_size and (self.breaker is None or self.breaker.state != OPEN)
+        return self._pending >= self.batch_size or counters_due or (
+            self._oldest is not None and time.monotonic() - self._oldest >= self.max_age)
+
+    def _timeout(self):
+        deadlines = []
+        if self._oldest is not None:
+            deadlines.append(self._oldest + self.max_age)
+        if self._replay_pending:
+            deadlines.append(self._last_replay + self.replay_interval)
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.monotonic(), 0.1)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._flush_due() and not self._replay_due():
+                    self._cond.wait(self._timeout())
+                if self._closed:
+                    return
+            if self._flush_due():
+                self.flush()
+            if self._replay_due():
+                self.replay()
+
+BREAKER = CircuitBreaker("database", **DATABASE['breaker'])
+JOURNAL = Journal(os.path.join(DATA_DIR, "journal"), **DATABASE['journal'])
+BUFFER = WriteBuffer(DB, breaker=BREAKER, journal=JOURNAL, **DATABASE['buffer'])
+atexit.register(BUFFER.close)
+
 def log_mod(redditor, mod):
     '''
     Log a request for a single mod to the database.
@@ -25,6 +359,118 @@ def log_mod(redditor, mod):
         "mod": mod.toObject()
     }
     log(record, REQUESTS)
+    count_mod(redditor, mod)
+
+def count_mod(redditor, mod, day=None):
+    '''
+    Count a request for a single mod, per mod, author, redditor and day.
+    '''
+    BUFFER.increment(MOD_COUNTS, mod.title, fields={"url": mod.url, "author": mod.author, "authorUrl": mod.profile})
+    BUFFER.increment(AUTHOR_COUNTS, mod.author, fields={"url": mod.profile})
+    BUFFER.increment(REDDITOR_COUNTS, redditor)
+    BUFFER.increment(DAILY_COUNTS, day or datetime.datetime.utcnow().date().isoformat())
+
+def ensure_indexes():
+    '''
+    Create the indexes we rely on, if they don't exist yet.
+        :returns: False if we couldn't (e.g. the database is down), we'll do without
+    '''
+    try:
+        for collection in COUNTERS:
+            collection.create_index([("count", DESCENDING)])
+        # latest links, and finding records to archive
+        for collection in RAW:
+            collection.create_index([("timestamp", DESCENDING)])
+        # the most linked mods of a redditor, and all requests for a mod
+        REQUESTS.create_index([("requestingRedditor", ASCENDING)])
+        REQUESTS.create_index([("mod.title", ASCENDING)])
+    except PyMongoError as err:
+        LOG.warning("couldn't create indexes: %s", err)
+        return False
+    return True
+
+def backfill():
+    '''
+    Rebuild all counters from the raw request records, and the ones in the archive. Counts made
+    while this runs may be lost, so best run while the bot is stopped.
+    '''
+    groups = {
+        MOD_COUNTS: {"_id": "$mod.title", "count": {"$sum": 1}, "url": {"$last": "$mod.url"},
+                     "author": {"$last": "$mod.author"}, "authorUrl": {"$last": "$mod.authorUrl"}},
+        AUTHOR_COUNTS: {"_id": "$mod.author", "count": {"$sum": 1}, "url": {"$last": "$mod.authorUrl"}},
+        REDDITOR_COUNTS: {"_id": "$requestingRedditor", "count": {"$sum": 1}},
+        # older timestamps are strings, "YYYY-MM-DD HH:MM:SS.ffffff", see `migrate`
+        DAILY_COUNTS: {"_id": {"$cond": [{"$eq": [{"$type": "$timestamp"}, "string"]},
+                                         {"$substr": ["$timestamp", 0, 10]},
+                                         {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}}]},
+                       "count": {"$sum": 1}}
+    }
+    for collection, group in groups.items():
+        started = time.monotonic()
+        # oldest first, so $last picks the most recent url and author
+        list(REQUESTS.aggregate([{"$sort": {"_id": 1}}, {"$group": group}, {"$out": collection.name}], allowDiskUse=True))
+        LOG.info("rebuilt %s: %s documents in %.1fs", collection.name, collection.count(), time.monotonic() - started)
+    _backfill_archived()
+    ensure_indexes()
+
+def _backfill_archived(batch_size=DATABASE['archive']['batch_size']):
+    # add the archived requests to the counters rebuilt from the live ones
+    counts = {collection: {} for collection in COUNTERS}
+
+    def _count(records):
+        # an archive run stopped between writing and deleting a batch leaves it in both places
+        live = {doc['_id'] for doc in REQUESTS.find({"_id": {"$in": [record['_id'] for record in records]}}, {"_id": 1})}
+        counted = 0
+        for record in records:
+            if record['_id'] in live:
+                continue
+            mod = record.get('mod', {})
+            timestamp = record['timestamp']
+            day = timestamp.date().isoformat() if isinstance(timestamp, datetime.datetime) else timestamp[:10]
+            for collection, key, fields in (
+                    (MOD_COUNTS, mod.get('title'), {"url": mod.get('url'), "author": mod.get('author'), "authorUrl": mod.get('authorUrl')}),
+                    (AUTHOR_COUNTS, mod.get('author'), {"url": mod.get('authorUrl')}),
+                    (REDDITOR_COUNTS, record.get('requestingRedditor'), None),
+                    (DAILY_COUNTS, day, None)):
+                entry = counts[collection].setdefault(key, [0, None])
+                entry[0] += 1
+                entry[1] = fields
+            counted += 1
+        return counted
+
+    counted = 0
+    seen = set() # and a batch archived twice is in the archive twice
+    batch = []
+    for record in Archive(DATABASE['archive']['directory']).read(REQUESTS.name):
+        if record['_id'] in seen:
+            continue
+        seen.add(record['_id'])
+        batch.append(record)
+        if len(batch) >= batch_size:
+            counted += _count(batch)
+            batch = []
+    if batch:
+        counted += _count(batch)
+    if not counted:
+        return
+
+    for collection, totals in counts.items():
+        operations = []
+        for key, (count, fields) in totals.items():
+            update = {"$inc": {"count": count}}
+            if fields:
+                # the live records are more recent, their urls and authors win
+                update["$setOnInsert"] = fields
+            operations.append(UpdateOne({"_id": key}, update, upsert=True))
+        for start in range(0, len(operations), batch_size):
+            collection.bulk_write(operations[start:start + batch_size], ordered=False)
+    LOG.info("counted %s archived requests", counted)
+
+def known_titles():
+    '''
+    Titles of all mods we've ever linked (or at least since the counters were backfilled).
+    '''
+    return [doc['_id'] for doc in MOD_COUNTS.find({}, {"_id": 1})]
 
 def log_pattern(redditor, pattern):
     '''
@@ -51,16 +497,111 @@ def log_post(redditor, post, submission, permalink):
 def log(record, collection):
     '''
     Basic log function, called by all the other loggers.
+    Queues the record to be written in the background.
     @param record: an object to be logged
     @param collection: a pymongo collection object
     '''
-    record['timestamp'] = str(datetime.datetime.now())
-    try:
-        collection.insert_one(record)
-    except Exception as err: # pylint: disable=W0703
-        LOG.error("%s in %s: .\n%s", type(err), collection, err)
+    record['timestamp'] = datetime.datetime.utcnow()
+    BUFFER.put(record, collection)
+
+def parse_timestamp(text):
+    '''
+    Datetime for a string timestamp, as we used to write them, or None if it isn't one.
+    '''
+    for timestamp_format in _STRING_TIMESTAMPS:
+        try:
+            return datetime.datetime.strptime(text, timestamp_format)
+        except ValueError:
+            continue
+    return None
+
+def migrate(batch_size=DATABASE['migrate_batch_size']):
+    '''
+    Convert string timestamps to datetimes, a batch at a time, so it can run while the bot is up.
+    The strings were local time on the server, which is UTC in the container.
+        :returns: number of records converted
+    '''
+    converted = 0
+    for collection in RAW:
+        last = None
+        while True:
+            query = {"timestamp": {"$type": _BSON_STRING}}
+            if last is not None:
+                query["_id"] = {"$gt": last}
+            batch = list(collection.find(query, {"timestamp": 1}).sort("_id", ASCENDING).limit(batch_size))
+            if not batch:
+                break
+            last = batch[-1]['_id']
+            operations = []
+            for record in batch:
+                timestamp = parse_timestamp(record['timestamp'])
+                if timestamp is None:
+                    LOG.warning("%s %s has a timestamp we can't read: %r", collection.name, record['_id'], record['timestamp'])
+                    continue
+                # only if nobody changed it in the meantime
+                operations.append(UpdateOne({"_id": record['_id'], "timestamp": record['timestamp']},
+                                            {"$set": {"timestamp": timestamp}}))
+            if operations:
+                converted += collection.bulk_write(operations, ordered=False).modified_count
+            LOG.info("%s: converted %s timestamps so far", collection.name, converted)
+    return converted
+
+def archive(max_age=DATABASE['archive']['max_age'], batch_size=DATABASE['archive']['batch_size']):
+    '''
+    Move raw records older than `max_age` seconds to the local archive, a batch at a time.
+    Records are only deleted once they're safely on disk; if we're stopped in between,
+    the next run archives them again, so the archive may have a few duplicates but never misses any.
+    Counters aren't affected, they keep counting archived requests.
+        :returns: number of records archived
+    '''
+    store = Archive(DATABASE['archive']['directory'])
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    archived = 0
+    for collection in RAW:
+        while True:
+            batch = list(collection.find({"timestamp": {"$lt": cutoff}}).sort("timestamp", ASCENDING).limit(batch_size))
+            if not batch:
+                break
+            store.append(collection.name, batch)
+            collection.delete_many({"_id": {"$in": [record['_id'] for record in batch]}})
+            archived += len(batch)
+            LOG.info("%s: archived %s records, up to %s", collection.name, archived, batch[-1]['timestamp'])
+    return archived
+
+def start_archiver(interval=DATABASE['archive']['interval']):
+    '''
+    Archive old records now, and then every `interval` seconds, in the background.
+    '''
+    def _run():
+        while True:
+            try:
+                archived = archive()
+                if archived:
+                    LOG.info("archived %s records", archived)
+            except Exception as exc: # pylint: disable=broad-except
+                LOG.exception(exc)
+            time.sleep(interval)
+    threading.Thread(target=_run, name="archiver", daemon=True).start()
+
+def close():
+    '''
+    Write out any buffered records, and stop the background writer.
+    '''
+    BUFFER.close()
+    LOG.info("database writer closed: %s", BUFFER.stats())
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(module)s :: %(levelname)s :: %(message)s', level=logging.INFO)
+    if sys.argv[1:] == ["backfill"]:
+        backfill()
+        sys.exit()
+    if sys.argv[1:] == ["migrate"]:
+        migrate()
+        ensure_indexes()
+        sys.exit()
+    if sys.argv[1:] == ["archive"]:
+        archive()
+        sys.exit()
     print(REQUESTS.count(), "requests logged")
     print(PATTERNS.count(), "patterns logged")
     print(POSTS.count(), "posts logged")
@@ -0,0 +1,190 @@
+'''
+Extract mods from workshop browse pages. There's a few interchangeable backends;
+
+ - `regex`: a targeted scanner that only looks at the few tags we care about.
+   It is by far the fastest, and can also work incrementally on a stream of chunks.
+ - `lxml`: a full (but fast) parse, if lxml is installed.
+ - `soup`: BeautifulSoup with the pure python html.parser. Slow, but forgiving.
+
+All backends take the raw html (bytes or str), and return a list of dicts with
+title, url, author and profile keys.
+
+Run this module to check that all backends agree on the saved pages in fixtures/workshop.
+'''
+import codecs
+import glob
+import html
+import logging
+import os
+import re
+import sys
+
+from bs4 import BeautifulSoup as bs
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "workshop")
+
+# pylint: disable=line-too-long
+_ITEM = re.compile(r'<div\b[^>]*?\bclass="(?:[^"]*\s)?workshopItem(?:\s[^"]*)?"', re.IGNORECASE)
+_TITLE = re.compile(r'<a\b[^>]*?\bhref="(?P<url>[^"]*)"[^>]*>\s*<div\b[^>]*?\bclass="(?:[^"]*\s)?workshopItemTitle(?:\s[^"]*)?"[^>]*>(?P<title>[^<]*)</div>', re.IGNORECASE)
+_AUTHOR = re.compile(r'<div\b[^>]*?\bclass="(?:[^"]*\s)?workshopItemAuthorName(?:\s[^"]*)?"[^>]*>[^<]*<a\b[^>]*?\bhref="(?P<profile>[^"]*)"[^>]*>(?P<author>[^<]*)</a>', re.IGNORECASE)
+# pylint: enable=line-too-long
+
+# how much of an unmatched buffer to hang on to, in case a tag is split between chunks.
+_TAIL = 256
+
+class ItemExtractor:
+    '''
+    Incremental version of the regex backend. Feed it chunks of a page as they
+    come in, and it returns each workshop item as soon as it's complete.
+    '''
+    def __init__(self):
+        self.count = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._buffer = ""
+        self._pos = 0
+
+    def feed(self, chunk):
+        '''
+        Add a chunk (bytes or str) of the page, and get a list of any newly completed items.
+        '''
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk)
+        buffer = self._buffer = self._buffer + chunk
+        items = []
+        while True:
+            start = _ITEM.search(buffer, self._pos)
+            if start is None:
+                self._pos = max(self._pos, len(buffer) - _TAIL)
+                break
+
+            # the author is the last thing in an item, wait for more input if we don't have it yet.
+            author = _AUTHOR.search(buffer, start.end())
+            if author is None:
+                self._pos = start.start()
+                break
+
+            # skip items that are missing an author altogether.
+            following = _ITEM.search(buffer, start.end(), author.start())
+            if following is not None:
+                self._pos = following.start()
+                continue
+
+            title = _TITLE.search(buffer, start.end(), author.start())
+            if title is not None:
+                items.append(dict(
+                    title=html.unescape(title.group('title')),
+                    url=html.unescape(title.group('url')),
+                    author=html.unescape(author.group('author')),
+                    profile=html.unescape(author.group('profile'))))
+            self._pos = author.end()
+
+        # drop whatever we're done with
+        self._buffer = buffer[self._pos:]
+        self._pos = 0
+        self.count += len(items)
+        return items
+
+    def close(self):
+        '''
+        Signal the end of the page, returns any remaining items.
+        '''
+        return self.feed(self._decoder.decode(b"", final=True))
+
+def scrape_regex(raw):
+    extractor = ItemExtractor()
+    return extractor.feed(raw) + extractor.close()
+
+def scrape_lxml(raw):
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8", errors="replace")
+    mods = []
+    doc = lxml.html.fromstring(raw)
+    for _mod in doc.find_class("workshopItem"):
+        if _mod.tag != "div":
+            continue
+        title_ele = [ele for ele in _mod.find_class("workshopItemTitle") if ele.tag == "div"][0]
+        author_ele = [ele for ele in _mod.find_class("workshopItemAuthorName") if ele.tag == "div"][0]
+        author_link = author_ele.find(".//a")
+        mods.append(dict(
+            title=title_ele.text,
+            url=title_ele.getparent().get('href'),
+            author=author_link.text,
+            profile=author_link.get('href')))
+    return mods
+
+def scrape_soup(raw):
+    mods = []
+    soup = bs(raw, features="html.parser")
+    for _mod in soup.select("div.workshopItem"):
+        title_ele = _mod.select_one("div.workshopItemTitle")
+        author_ele = _mod.select_one("div.workshopItemAuthorName")
+        # note; cast to plain strings, NavigableStrings keep the whole tree alive.
+        mods.append(dict(
+            title=str(title_ele.string),
+            url=title_ele.parent['href'],
+            author=str(author_ele.a.string),
+            profile=author_ele.a['href']))
+    return mods
+
+BACKENDS = {
+    "regex": scrape_regex,
+    "soup": scrape_soup
+}
+if lxml is not None:
+    BACKENDS["lxml"] = scrape_lxml
+
+def get_backend(name):
+    '''
+    Get an extraction function by name. `auto` gets the fastest available backend,
+    unknown or unavailable backends fall back to BeautifulSoup.
+    '''
+    if name == "auto":
+        name = "regex"
+    if name not in BACKENDS:
+        log.warning("scraper backend '%s' is not available, using 'soup'", name)
+        name = "soup"
+    return BACKENDS[name]
+
+def _as_tuples(mods):
+    return [(mod['title'], mod['url'], mod['author'], mod['profile']) for mod in mods]
+
+def check_parity(paths):
+    '''
+    Check that all backends extract identical title/url/author/profile tuples.
+        :returns: list of (path, backend) that didn't match the soup backend
+    '''
+    failures = []
+    for path in paths:
+        with open(path, "rb") as page:
+            raw = page.read()
+        expected = _as_tuples(scrape_soup(raw))
+        for name, backend in sorted(BACKENDS.items()):
+            if _as_tuples(backend(raw)) != expected:
+                failures.append((path, name))
+            # the streaming extractor should not care about chunk boundaries
+            if name == "regex":
+                for size in (1, 7, 512, 4096):
+                    extractor = ItemExtractor()
+                    mods = []
+                    for offset in range(0, len(raw), size):
+                        mods += extractor.feed(raw[offset:offset+size])
+                    mods += extractor.close()
+                    if _as_tuples(mods) != expected:
+                        failures.append((path, "{}/{}".format(name, size)))
+    return failures
+
+if __name__ == '__main__':
+    pages = sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURES, "*.html")))
+    print("checking {} backends ({}) on {} pages".format(len(BACKENDS), ", ".join(sorted(BACKENDS)), len(pages)))
+    mismatches = check_parity(pages)
+    for page, backend in mismatches:
+        print("\tMISMATCH: {} on {}".format(backend, page))
+    print("all good!" if not mismatches else "{} mismatches".format(len(mismatches)))
+    sys.exit(1 if mismatches else 0)
@@ -1,5 +1,5 @@
 import logging
-from common import MAX_LENGTH, FOOTER
+from common import MAX_LENGTH, FOOTER, PACKING
 
 log = logging.getLogger(__name__) # pylint: disable=invalid-name
 
@@ -29,50 +29,85 @@ def formatResults(request, mods):
     return result
 
 def formatMod(mod, tabular=False):
-    print_alpha = not mod.nameIncludesVersion()
     if tabular:
-        if print_alpha:
-            return '[{alpha}] [{title}]({url}) | by [{author}]({profile})\n'.format(**vars(mod))
-        else:
-            return '[{title}]({url}) | by [{author}]({profile})\n'.format(**vars(mod))
-    else:
-        if print_alpha:
-            return '[{alpha}] [{title}]({url}) by [{author}]({profile})\n'.format(**vars(mod))
-        else:
-            return '[{title}]({url}) by [{author}]({profile})\n'.format(**vars(mod))
+        if mod.includesVersion:
+            return '[{0.title}]({0.url}) | by [{0.author}]({0.profile})\n'.format(mod)
+        return '[{0.alpha}] [{0.title}]({0.url}) | by [{0.author}]({0.profile})\n'.format(mod)
+    if mod.includesVersion:
+        return '[{0.title}]({0.url}) by [{0.author}]({0.profile})\n'.format(mod)
+    return '[{0.alpha}] [{0.title}]({0.url}) by [{0.author}]({0.profile})\n'.format(mod)
 
-def createPosts(parts):
+def createPosts(parts, packing=PACKING):
     """
     paste parts that fit in one comment together,
     spread out over multiple comments if need be
         :param parts: list of search response strings, see `formatResults`
+        :param packing: how to spread parts over comments;
+            `greedy` fills comments in order,
+            `ffd` (first fit decreasing) puts the largest parts in first, to use as few comments as possible,
+            `ffd-stable` does the same, but keeps parts (and comments) in the order they were asked for.
     """
-    posts = []
-    reply = ""
-    while parts and len(reply) + len(FOOTER) < MAX_LENGTH:
-        # get the next part
-        part = parts.popleft()
-
-        # add it to the reply if it fits
-        if len(part) + len(reply) + len(FOOTER) <= MAX_LENGTH:
-            reply += "\n\n" + part
-
+    fitting = []
+    for part in parts:
         # remove it if it could never fit (shouldn't really be possible, unless MAX_REPLIES is raised to 30 and we get some very long mod/author names)
-        elif len(part) + len(FOOTER) > MAX_LENGTH:
+        if len(part) + len(FOOTER) > MAX_LENGTH:
             log.warning("comment too long (%d/%d), skipping", len(part) + len(FOOTER), MAX_LENGTH)
             log.debug(part)
             continue
+        fitting.append(part)
 
-        # else requeue this part, and post a reply
-        else:
-            parts.appendleft(part)
-            posts.append(reply + FOOTER)
+    if packing == "greedy":
+        bins = _packGreedy(fitting)
+    elif packing in ("ffd", "ffd-stable"):
+        bins = _packFirstFitDecreasing(fitting, packing == "ffd-stable")
+        # first fit decreasing is nearly always better, but not quite always
+        greedy = _packGreedy(fitting)
+        if len(greedy) < len(bins):
+            bins = greedy
+    else:
+        raise ValueError("unknown packing {}".format(packing))
 
-            # reset reply
-            reply = ""
+    return ["".join("\n\n" + fitting[index] for index in indices) + FOOTER for indices in bins]
 
-    # if we exited the last block with a non "" reply, we still have a non-full reply to make
-    if reply:
-        posts.append(reply + FOOTER)
+def _fits(size, part):
+    # size is the length of the reply so far, including separators
+    return len(part) + size + len(FOOTER) <= MAX_LENGTH
 
-    return posts
+def _packGreedy(parts):
+    """
+    add parts to the reply while they fit, start a new reply when they don't.
+        :returns: list of lists of part indices
+    """
+    bins = []
+    current = []
+    size = 0
+    for index, part in enumerate(parts):
+        if current and not _fits(size, part):
+            bins.append(current)
+            current = []
+            size = 0
+        current.append(index)
+        size += len(part) + 2
+    if current:
+        bins.append(current)
+    return bins
+
+def _packFirstFitDecreasing(parts, stable=False):
+    """
+    put each part in the first reply it fits in, largest parts first.
+        :returns: list of lists of part indices
+    """
+    bins = []
+    sizes = []
+    for index in sorted(range(len(parts)), key=lambda index: -len(parts[index])):
+        for number, size in enumerate(sizes):
+            if _fits(size, parts[index]):
+                bins[number].append(index)
+                sizes[number] += len(parts[index]) + 2
+                break
+        else:
+            bins.append([index])
+            sizes.append(len(parts[index]) + 2)
+    if stable:
+        bins = sorted(sorted(indices) for indices in bins)
+    return bins
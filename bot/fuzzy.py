@@ -0,0 +1,148 @@
+'''
+Fuzzy matching of (misspelled) queries against known mod titles, using a trigram index.
+'''
+import logging
+import re
+import threading
+
+from cache import normalize
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# where mod titles tend to stop being the name people use, e.g. "Mod Name - a mod that does x"
+_SUBTITLE = re.compile(r"\s+[-:|(\[]|\s+v?\d+(\.\d+)+")
+_MIN_ALIAS = 8 # characters
+
+def trigrams(text):
+    '''
+    Set of character trigrams of the normalized text, padded so that the start
+    and end of words count as well.
+    '''
+    padded = "  {} ".format(normalize(text))
+    return {padded[index:index+3] for index in range(len(padded) - 2)}
+
+def aliases(title):
+    '''
+    Shorter names a mod might be asked for by; the part before any subtitle, and
+    the leading words of the title (at least two of them).
+    '''
+    names = set()
+    short = _SUBTITLE.split(title, 1)[0].strip()
+    if short != title and len(short) >= _MIN_ALIAS:
+        names.add(short)
+    words = short.split()
+    for end in range(2, len(words)):
+        prefix = " ".join(words[:end])
+        if len(prefix) >= _MIN_ALIAS:
+            names.add(prefix)
+    return names
+
+class TitleMatcher:
+    '''
+    Finds the known title most similar to a query, by the Dice coefficient of
+    their trigram sets. Titles are also indexed under their aliases, so "Expanded
+    Prostetics" can find "Expanded Prosthetics and Organ Engineering". Titles are
+    only scored if they share enough trigrams with the query to possibly reach
+    the threshold, so only a handful of candidates are ever scored, even with many
+    thousands of titles.
+    '''
+    def __init__(self, threshold=0.6):
+        self.threshold = threshold
+        self._titles = []
+        self._names = [] # (title index, trigrams, is the full title) per indexed name
+        self._known = {}
+        self._postings = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._titles)
+
+    def add(self, title):
+        '''
+        Add a known mod title (and its aliases), if we didn't know it yet.
+        '''
+        key = normalize(title)
+        if not key:
+            return
+        with self._lock:
+            if key in self._known:
+                return
+            ident = len(self._titles)
+            self._titles.append(title)
+            self._known[key] = ident
+            self._index(ident, title, True)
+            for alias in aliases(title):
+                self._index(ident, alias, False)
+
+    def _index(self, ident, name, full):
+        grams = frozenset(trigrams(name))
+        number = len(self._names)
+        self._names.append((ident, grams, full))
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(number)
+
+    def match(self, query):
+        '''
+        Best matching known title, or None if nothing is similar enough.
+            :returns: (title, score)
+        '''
+        key = normalize(query)
+        if not key:
+            return None
+        with self._lock:
+            if key in self._known:
+                return self._titles[self._known[key]], 1.0
+
+            grams = trigrams(query)
+            size = len(grams)
+            # dice = 2 * shared / (size + other) >= threshold, so a candidate needs at least
+            # threshold * size / (2 - threshold) shared trigrams, and can't be too long or short.
+            minimum = self.threshold * size / (2 - self.threshold)
+            longest = size * (2 - self.threshold) / self.threshold
+            shortest = size * self.threshold / (2 - self.threshold)
+
+            # a title sharing at least `minimum` trigrams with the query must be in at least one of
+            # the `size - minimum + 1` rarest posting lists, so those give us all the candidates.
+            postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+            candidates = set()
+            for posting in postings[:int(size - minimum) + 1]:
+                candidates.update(posting)
+
+            best, score = None, (0.0, False)
+            for name in candidates:
+                ident, other, full = self._names[name]
+                if not shortest <= len(other) <= longest:
+                    continue
+                # on a tie, prefer a full title over an alias
+                dice = (2 * len(grams & other) / (size + len(other)), full)
+                if dice > score:
+                    best, score = ident, dice
+            score = score[0]
+
+        if best is None or score < self.threshold:
+            return None
+        return self._titles[best], score
+
+if __name__ == '__main__':
+    import random
+    import string
+    import time
+
+    # tens of thousands of made up titles, plus a few real ones to find
+    rng = random.Random(13)
+    words = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))) for _ in range(5000)]
+    matcher = TitleMatcher()
+    for _ in range(50000):
+        matcher.add(" ".join(rng.choice(words).capitalize() for _ in range(rng.randint(1, 5))))
+    for title in ["Expanded Prosthetics and Organ Engineering", "Colony Manager", "RimHUD", "Work Tab",
+                  "Vanilla Furniture Expanded - Security", "Dubs Bad Hygiene", "Pick Up And Haul"]:
+        matcher.add(title)
+    print("{} titles".format(len(matcher)))
+
+    for query in ["Expanded Prostetics", "colony manger", "rimhud", "worktab", "vanila furniture expanded",
+                  "dubs bad hygene", "pickup and haul", "nothing like any mod"]:
+        start = time.perf_counter()
+        for _ in range(100):
+            result = matcher.match(query)
+        elapsed = (time.perf_counter() - start) * 10
+        print("\t{} -> {} ({:.3f}ms)".format(query, "{} ({:.2f})".format(*result) if result else None, elapsed))
@@ -0,0 +1,69 @@
+'''
+Shared HTTP session for workshop requests. Connections are kept alive and reused,
+every request gets a timeout, and failed requests are retried with exponential backoff.
+'''
+import logging
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from common import HTTP, REDDIT
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# retry connection errors, rate limits and server errors, backing off
+# {backoff} * 2^(n-1) seconds between attempts (and honouring Retry-After).
+_retry = Retry( # pylint: disable=invalid-name
+    total=HTTP['retries'],
+    backoff_factor=HTTP['backoff'],
+    status_forcelist=(429, 500, 502, 503, 504),
+    raise_on_status=False)
+_adapter = HTTPAdapter(pool_connections=HTTP['pool_hosts'], # pylint: disable=invalid-name
+                       pool_maxsize=HTTP['pool_size'],
+                       max_retries=_retry)
+
+session = Session() # pylint: disable=invalid-name
+session.headers.update({
+    "User-Agent": REDDIT['user_agent'],
+    "Accept-Encoding": "gzip, deflate"
+})
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+def get(url, **kwargs):
+    '''
+    GET `url` over the shared session. Takes the same arguments as `requests.get`,
+    but uses the configured (connect, read) timeout by default.
+    '''
+    kwargs.setdefault("timeout", (HTTP['connect_timeout'], HTTP['read_timeout']))
+    return session.get(url, **kwargs)
+
+def stats():
+    '''
+    Connection reuse statistics for each host we've talked to. Note that pools for
+    hosts we haven't talked to in a while may have been discarded.
+        :returns: dict of host -> {connections, requests, reused}
+    '''
+    hosts = {}
+    pools = _adapter.poolmanager.pools
+    for key in pools.keys():
+        try:
+            pool = pools[key]
+        except KeyError:
+            continue
+        host = "{}://{}:{}".format(pool.scheme, pool.host, pool.port)
+        hosts[host] = {
+            "connections": pool.num_connections,
+            "requests": pool.num_requests,
+            "reused": max(pool.num_requests - pool.num_connections, 0)
+        }
+    return hosts
+
+def _stat(name):
+    return lambda: {host: counts[name] for host, counts in stats().items()}
+
+metrics.gauges("modlinker_http_connections", "Connections opened per host", "host", _stat("connections"))
+metrics.gauges("modlinker_http_requests", "Requests made per host", "host", _stat("requests"))
+metrics.gauges("modlinker_http_reused", "Requests per host that reused a kept-alive connection", "host", _stat("reused"))
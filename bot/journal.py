@@ -0,0 +1,126 @@
+'''
+Append-only local journal for database records that couldn't be written, so they
+can be replayed once the database is back.
+
+Records are stored as JSON lines (in MongoDB extended JSON, so ids and dates
+survive the round trip), in segment files that are rotated once they grow over
+`max_bytes`. Lines that can't be replayed (torn by a crash mid-write, or records
+the database refuses) are moved to a quarantine file next to the segments, so
+they can't hold up the ones behind them.
+'''
+import glob
+import logging
+import os
+import threading
+import time
+
+from bson import json_util
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+class Journal:
+    def __init__(self, directory, prefix="spill", max_bytes=8*1024*1024):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.replayed = 0
+        self.quarantined = 0
+        self._current = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, collection, records):
+        '''
+        Add records for the named collection to the journal.
+        '''
+        lines = "".join(json_util.dumps({"collection": collection, "record": record}) + "\n" for record in records)
+        with self._lock:
+            if self._current is None or os.path.getsize(self._current) >= self.max_bytes:
+                self._current = self._new_segment()
+            with open(self._current, "a", encoding="utf-8") as segment:
+                segment.write(lines)
+                segment.flush()
+                os.fsync(segment.fileno())
+            self.written += len(records)
+
+    def pending(self):
+        return bool(self.segments())
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, "{}-*.jsonl".format(self.prefix))))
+
+    @property
+    def quarantine(self):
+        return os.path.join(self.directory, "{}.quarantine.jsonl".format(self.prefix))
+
+    def replay(self, insert, batch_size=1000, max_segments=1):
+        '''
+        Replay the oldest journal segment(s). Each batch of records is handed to
+        `insert(collection, records)`, which returns the records that can never be
+        written (if any); those are quarantined, like lines we can't read. A segment
+        is removed once all of it has been replayed; if an insert raises, whatever is
+        left is kept for the next attempt.
+            :returns: number of records replayed
+        '''
+        replayed = 0
+        with self._lock:
+            # start a new segment for anything appended from here on, so we never replay a segment that is still growing
+            self._current = None
+            segments = self.segments()[:max_segments]
+        for path in segments:
+            with open(path, encoding="utf-8", errors="replace") as segment:
+                lines = segment.readlines()
+            done = 0
+            try:
+                while done < len(lines):
+                    batch = lines[done:done+batch_size]
+                    collections = {}
+                    rejected = []
+                    for line in batch:
+                        try:
+                            entry = json_util.loads(line)
+                            collections.setdefault(entry['collection'], []).append(entry['record'])
+                        except (ValueError, KeyError, TypeError):
+                            # a line torn by a crash mid-write
+                            if line.strip():
+                                rejected.append(line if line.endswith("\n") else line + "\n")
+                    for collection, records in collections.items():
+                        rejected.extend(json_util.dumps({"collection": collection, "record": record}) + "\n"
+                                        for record in insert(collection, records) or ())
+                    if rejected:
+                        self._quarantine(path, rejected)
+                    done += len(batch)
+                    replayed += len(batch) - len(rejected)
+            finally:
+                if done >= len(lines):
+                    os.remove(path)
+                elif done:
+                    self._rewrite(path, lines[done:])
+        self.replayed += replayed
+        return replayed
+
+    def _quarantine(self, path, lines):
+        with open(self.quarantine, "a", encoding="utf-8") as quarantine:
+            quarantine.writelines(lines)
+            quarantine.flush()
+            os.fsync(quarantine.fileno())
+        self.quarantined += len(lines)
+        log.warning("moved %s records we can't replay from %s to %s", len(lines), os.path.basename(path), self.quarantine)
+
+    def _rewrite(self, path, lines):
+        temp = path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as segment:
+            segment.writelines(lines)
+            segment.flush()
+            os.fsync(segment.fileno())
+        os.replace(temp, path)
+
+    def _new_segment(self):
+        # sortable by age; add a counter in case we rotate more than once within the same second
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        for index in range(1000):
+            path = os.path.join(self.directory, "{}-{}-{:03d}.jsonl".format(self.prefix, stamp, index))
+            if not os.path.exists(path):
+                return path
+        raise RuntimeError("could not create a journal segment in {}".format(self.directory))
@@ -0,0 +1,69 @@
+'''
+Adaptive concurrency limit, to back off from a service that is struggling.
+'''
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+class AdaptiveLimiter:
+    '''
+    Limits the number of concurrent calls to a service, and adapts that limit AIMD
+    style (like TCP congestion control); every call that succeeds within
+    `target_latency` seconds adds 1/limit to the limit, so it grows by about one
+    per round of calls, and a failed or slow call multiplies it by `backoff`. To
+    not collapse on a burst of failures from calls that were all made at once,
+    the limit is cut at most once per `target_latency` seconds.
+    '''
+    def __init__(self, name, initial=4, minimum=1, maximum=8, target_latency=2.0, backoff=0.5):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.active = 0
+        self.decreases = 0
+        self._decreased = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        '''
+        Wait for a free slot.
+            :returns: False if we timed out
+        '''
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.active < int(self.limit), timeout):
+                return False
+            self.active += 1
+            return True
+
+    def release(self, latency, success=True):
+        '''
+        Give back a slot, with how the call went.
+        '''
+        with self._cond:
+            self.active -= 1
+            if success and latency <= self.target_latency:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            elif time.monotonic() - self._decreased >= self.target_latency:
+                before = int(self.limit)
+                self.limit = max(self.limit * self.backoff, self.minimum)
+                self._decreased = time.monotonic()
+                self.decreases += 1
+                if int(self.limit) < before:
+                    log.info("%s is struggling (%s after %.1fs), limiting to %s concurrent calls",
+                             self.name, "ok" if success else "failed", latency, int(self.limit))
+            self._cond.notify_all()
+
+    def cancel(self):
+        '''
+        Give back a slot we ended up not using, without it counting either way.
+        '''
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        return {"limit": int(self.limit), "active": self.active, "decreases": self.decreases}
@@ -0,0 +1,348 @@
+'''
+End-to-end load test of the modlinker, without touching reddit, steam or the database.
+
+The real `ModLinker` is fed a fake comment stream at a fixed rate, searches go to a
+local http server that serves the saved workshop pages (with configurable latency
+and errors), replies go to a fake sink that enforces a reddit style rate limit,
+and database records are kept in memory. At the end we report the sustained
+comment rate, how long it took from a comment coming in to the reply going out,
+and how the stage queues grew.
+
+    python loadtest.py --rate 20 --comments 2000 --steam-latency 0.3 --steam-errors 0.05
+    python loadtest.py --rate 0 --requests 1.0 --corpus comments.txt   # as fast as possible, every comment asks for something
+'''
+# pylint: disable=wrong-import-position
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import praw
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# reddit ids are base 36, start well above anything real
+_FIRST_ID = int("zz000000", 36)
+
+def _base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+    return result or "0"
+
+def percentiles(values, percents=(50, 90, 99)):
+    ordered = sorted(values)
+    if not ordered:
+        return {"p{}".format(percent): None for percent in percents}
+    return {"p{}".format(percent): ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+            for percent in percents}
+
+class SteamHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the saved workshop pages for any search, picking a page by the search text.
+    '''
+    pages = []
+    latency = 0.0
+    errors = 0.0
+    requests = 0
+    failed = 0
+    _lock = threading.Lock()
+
+    def do_GET(self): # pylint: disable=invalid-name
+        with self._lock:
+            SteamHandler.requests += 1
+        if self.latency:
+            time.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.errors:
+            with self._lock:
+                SteamHandler.failed += 1
+            self.send_error(random.choice([429, 502, 503]))
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        text = query.get('searchtext', [""])[0]
+        page = self.pages[int(hashlib.md5(text.encode("utf-8")).hexdigest(), 16) % len(self.pages)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is python 3.7+
+    daemon_threads = True
+
+def start_steam(latency=0.0, errors=0.0):
+    '''
+    Start the fake workshop server on a free local port.
+        :returns: the server, serving on a background thread
+    '''
+    SteamHandler.pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "workshop", "*.html"))):
+        with open(path, "rb") as page:
+            SteamHandler.pages.append(page.read())
+    SteamHandler.latency = latency
+    SteamHandler.errors = errors
+    server = _Server(("127.0.0.1", 0), SteamHandler)
+    threading.Thread(target=server.serve_forever, name="fake-steam", daemon=True).start()
+    return server
+
+class FakeRedditor:
+    def __init__(self, name):
+        self.name = name
+
+class FakeReply:
+    def __init__(self, comment_id):
+        self.permalink = "/r/loadtest/comments/{}/_/{}/".format(_base36(_FIRST_ID), comment_id)
+        self.submission = FakeSubmission()
+
+class FakeSubmission:
+    title = "load test"
+
+class FakeComment:
+    def __init__(self, number, body, sink):
+        self.id = _base36(_FIRST_ID + number)
+        self.body = body
+        self.author = FakeRedditor("redditor{}".format(number % 50))
+        self.created_utc = time.time()
+        self.arrived = time.monotonic()
+        self.replies = []
+        self._sink = sink
+
+    def reply(self, body):
+        return self._sink.reply(self, body)
+
+    def refresh(self):
+        pass
+
+class ReplySink:
+    '''
+    Stands in for reddit when replying. Each reply takes `latency` seconds, and
+    at most `per_minute` replies are allowed in any minute; over that, replying
+    raises the same RATELIMIT error reddit gives us.
+    '''
+    def __init__(self, latency=0.0, per_minute=0):
+        self.latency = latency
+        self.per_minute = per_minute
+        self.replies = 0
+        self.ratelimited = 0
+        self.latencies = []
+        self.first_reply = {}
+        self._recent = []
+        self._lock = threading.Lock()
+
+    def reply(self, comment, body): # pylint: disable=unused-argument
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            now = time.monotonic()
+            if self.per_minute:
+                self._recent = [when for when in self._recent if now - when < 60]
+                if len(self._recent) >= self.per_minute:
+                    self.ratelimited += 1
+                    wait = 60 - (now - self._recent[0])
+                    raise praw.exceptions.APIException(
+                        "RATELIMIT", "you are doing that too much. try again in {} seconds.".format(int(wait) + 1), "ratelimit")
+                self._recent.append(now)
+            self.replies += 1
+            self.latencies.append(now - comment.arrived)
+            self.first_reply.setdefault(comment.id, now - comment.arrived)
+        return FakeReply(comment.id)
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self.documents = {}
+
+    def insert_many(self, records, ordered=True): # pylint: disable=unused-argument
+        self.records.extend(records)
+
+    def bulk_write(self, operations, ordered=True): # pylint: disable=unused-argument
+        # only the counter upserts, see database.WriteBuffer.increment
+        for operation in operations:
+            key = operation._filter["_id"] # pylint: disable=protected-access
+            update = operation._doc # pylint: disable=protected-access
+            document = self.documents.setdefault(key, {"_id": key, "count": 0})
+            document["count"] += update["$inc"]["count"]
+            document.update(update.get("$set", {}))
+
+class MemoryDatabase:
+    '''
+    Just enough of a pymongo database for the write buffer.
+    '''
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, MemoryCollection(name))
+
+    def counts(self):
+        return {name: len(collection.records) or len(collection.documents) for name, collection in self.collections.items()}
+
+def corpus(path=None, requests=0.1, seed=15):
+    '''
+    Endless stream of comment bodies; lines of a file if given (with `\\n` for newlines),
+    or made up chatter where a `requests` fraction of comments ask for mods.
+    '''
+    rng = random.Random(seed)
+    if path:
+        with open(path, encoding="utf-8") as lines:
+            bodies = [line.rstrip("\n").replace("\\n", "\n") for line in lines if line.strip()]
+        while True:
+            yield rng.choice(bodies)
+    with open(os.path.join(FIXTURES, "commands.txt"), encoding="utf-8") as examples:
+        commands = [line.rstrip("\n") for line in examples if line.strip()]
+    words = "the colony raiders pawn mod some a for that with my of is was and not this".split()
+    while True:
+        body = " ".join(rng.choice(words) for _ in range(rng.randint(5, 80)))
+        if rng.random() < requests:
+            body += "\n\n" + "\n".join(rng.choice(commands) for _ in range(rng.choice([1, 1, 1, 2, 3])))
+        yield body
+
+def stream(bodies, sink, rate, count, lag):
+    '''
+    Fake comment stream, yielding `count` comments at `rate` per second (0 for as fast
+    as they're taken). Records how far behind schedule each comment was taken in `lag`.
+    '''
+    start = time.monotonic()
+    for number in range(count):
+        if rate:
+            due = start + number / rate
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                lag.append(-wait)
+        yield FakeComment(number, next(bodies), sink)
+
+def sample_queues(bot, samples, interval, stopped):
+    while not stopped.wait(interval):
+        samples.append((time.monotonic(), {stage.name: stage.queue.qsize() for stage in bot.pipeline.stages}))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the modlinker against local stand-ins for reddit, steam and the database.")
+    parser.add_argument("--comments", type=int, default=1000, help="number of comments (default: 1000)")
+    parser.add_argument("--rate", type=float, default=20, help="comments per second, 0 for as fast as possible (default: 20)")
+    parser.add_argument("--requests", type=float, default=0.1, help="fraction of synthetic comments asking for mods (default: 0.1)")
+    parser.add_argument("--corpus", metavar="PATH", help="replay comment bodies from a file, one per line")
+    parser.add_argument("--steam-latency", type=float, default=0.2, help="mean seconds per workshop search (default: 0.2)")
+    parser.add_argument("--steam-errors", type=float, default=0.0, help="fraction of workshop searches that fail (default: 0)")
+    parser.add_argument("--reply-latency", type=float, default=0.1, help="seconds per reply (default: 0.1)")
+    parser.add_argument("--ratelimit", type=int, default=0, help="replies allowed per minute, 0 for no limit (default: 0)")
+    parser.add_argument("--no-cache", action="store_true", help="don't cache search results")
+    parser.add_argument("--profile", type=int, default=0, metavar="N", help="profile the first N comments, see profiling")
+    parser.add_argument("--json", metavar="PATH", help="save the report as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log what the bot is doing")
+    args = parser.parse_args(argv)
+
+    # the bot reads its settings when imported, so set them up first
+    defaults = {"RIMWORLD_CURRENT_ALPHA": "1.0", "REDDIT_USER": "modlinker", "REDDIT_PASSWORD": "",
+                "REDDIT_CLIENT_ID": "", "REDDIT_CLIENT_SECRET": "", "REDDIT_LISTEN_TO": "loadtest",
+                "STEAM_KEY": "", "MONGO_URI": "mongodb://127.0.0.1:1/",
+                "MODLINKER_DATA": tempfile.mkdtemp(prefix="modlinker-loadtest-"),
+                "MODLINKER_STAGE_REPORT_INTERVAL": "0", "MODLINKER_DB_FLUSH_INTERVAL": "0.5",
+                # the sink plays reddit's rate limit (--ratelimit); the bot shouldn't throttle itself on top
+                "MODLINKER_REPLY_RATE": "0"}
+    if args.no_cache:
+        defaults["MODLINKER_CACHE_ENTRIES"] = "0"
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    logging.basicConfig(format='%(threadName)s :: %(module)s :: %(levelname)s :: %(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
+
+    from common import STEAM
+    import database
+    import modlinker
+    import workshop_scraper
+
+    steam = start_steam(args.steam_latency, args.steam_errors)
+    STEAM['WORKSHOP']['search_url'] = "http://127.0.0.1:{}/workshop/browse/?{{params}}".format(steam.server_address[1])
+    memory = MemoryDatabase()
+    database.BUFFER.database = memory
+
+    sink = ReplySink(args.reply_latency, args.ratelimit)
+    bot = modlinker.ModLinker()
+    if args.profile:
+        bot.profiler.start(comments=args.profile, seconds=0)
+    lag = []
+    samples = []
+    stopped = threading.Event()
+    threading.Thread(target=sample_queues, args=(bot, samples, 0.5, stopped), name="loadtest-sampler", daemon=True).start()
+
+    print("data in {}, steam at {}".format(os.environ['MODLINKER_DATA'], STEAM['WORKSHOP']['search_url'].format(params="")))
+    start = time.monotonic()
+    bot.run(stream(corpus(args.corpus, args.requests), sink, args.rate, args.comments, lag))
+    elapsed = time.monotonic() - start
+    stopped.set()
+    database.BUFFER.flush()
+
+    report = {
+        "comments": args.comments,
+        "seconds": elapsed,
+        "comments_per_second": args.comments / elapsed,
+        "target_rate": args.rate,
+        "stream_lag": dict(max=max(lag, default=0.0), behind=len(lag)),
+        "replies": sink.replies,
+        "replied_comments": len(sink.first_reply),
+        "ratelimited": sink.ratelimited,
+        "first_reply_latency": percentiles(sink.first_reply.values()),
+        "reply_latency": percentiles(sink.latencies),
+        "steam": dict(requests=SteamHandler.requests, failed=SteamHandler.failed),
+        "cache": workshop_scraper.cache.stats(),
+        "flights": workshop_scraper.flights.stats(),
+        "database": memory.counts(),
+        "stages": bot.pipeline.stats(),
+        "queues": {name: dict(max=max((depths[name] for _, depths in samples), default=0),
+                              growth=_growth([(when, depths[name]) for when, depths in samples]))
+                   for name in (stage.name for stage in bot.pipeline.stages)}
+    }
+
+    print("{comments} comments in {seconds:.1f}s: {comments_per_second:.1f}/s (target {target_rate:g}/s)".format(**report))
+    print("stream fell behind for {behind} comments, by up to {max:.2f}s".format(**report['stream_lag']))
+    print("{} replies to {} comments, {} rate limited".format(sink.replies, len(sink.first_reply), sink.ratelimited))
+    for name in ("first_reply_latency", "reply_latency"):
+        print("{:<20} {}".format(name, "  ".join("{}: {}".format(key, "{:.2f}s".format(value) if value is not None else "-")
+                                                  for key, value in report[name].items())))
+    print("steam: {requests} requests, {failed} failed".format(**report['steam']))
+    print("searches: {calls} fetches, {deduplicated} shared an identical fetch, up to {max_waiters} waiting on one".format(
+        **report['flights']))
+    print("database: {}".format(report['database']))
+    for name, stats in report['stages'].items():
+        queue = report['queues'][name]
+        print("{:<10} {processed:>6} done ({throughput:.1f}/s), {failed} failed, {utilization:.0%} busy, "
+              "queue max {max}, growth {growth:+.2f}/s".format(name, max=queue['max'], growth=queue['growth'], **stats))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    steam.shutdown()
+    return 0
+
+def _growth(points):
+    '''
+    Least squares slope of queue depth over time, in items per second.
+    '''
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread if spread else 0.0
+
+if __name__ == '__main__':
+    sys.exit(main())
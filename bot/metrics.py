@@ -0,0 +1,294 @@
+'''
+Lightweight metrics for the hot paths of the bot; counters, gauges and fixed-bucket
+histograms, kept in memory in a registry.
+
+They can be served in the Prometheus text format on a local http endpoint, see
+`serve`, and/or summarized in the log every so often, see `start_reporter`.
+Recording a value is a lock and a bisect, so cheap enough to do per comment.
+'''
+import bisect
+import logging
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# seconds, from a fast parse to waiting out a rate limit
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 4*1024, 16*1024, 64*1024, 256*1024, 1024*1024, 4*1024*1024)
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in sorted(labels.items())) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=None): # pylint: disable=redefined-builtin
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+    def summary(self):
+        return "{}".format(self.value) if self.value else None
+
+class Gauge:
+    '''
+    A value that is read when needed, from `func`.
+    '''
+    kind = "gauge"
+
+    def __init__(self, name, help, func, labels=None): # pylint: disable=redefined-builtin
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.func = func
+
+    def samples(self):
+        return [(self.name, self.labels, self.func())]
+
+    def summary(self):
+        return "{:g}".format(self.func())
+
+class GaugeSet:
+    '''
+    Values for a varying set of label values (e.g. hosts), all read when needed from
+    `func`, which returns a dict of label value -> value.
+    '''
+    kind = "gauge"
+
+    def __init__(self, name, help, label, func): # pylint: disable=redefined-builtin
+        self.name = name
+        self.help = help
+        self.labels = {}
+        self.label = label
+        self.func = func
+
+    def samples(self):
+        return [(self.name, {self.label: key}, value) for key, value in sorted(self.func().items())]
+
+    def summary(self):
+        values = sorted(self.func().items())
+        if not values:
+            return None
+        return ", ".join("{} {:g}".format(key, value) for key, value in values)
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=None): # pylint: disable=redefined-builtin
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        '''
+        Context manager observing the seconds spent in its block.
+        '''
+        return _Timer(self)
+
+    def percentile(self, percent):
+        '''
+        Estimate of a percentile; the upper bound of the bucket it falls in.
+        '''
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = count * percent / 100
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket
+            samples.append((self.name + "_bucket", dict(self.labels, le=_number(bound)), cumulative))
+        samples.append((self.name + "_sum", self.labels, total))
+        samples.append((self.name + "_count", self.labels, count))
+        return samples
+
+    def summary(self):
+        if not self.count:
+            return None
+        return "{} (mean {:.4g}, p50 <= {:g}, p99 <= {:g})".format(
+            self.count, self.sum / self.count, self.percentile(50), self.percentile(99))
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        '''
+        Add a metric, or get the one already registered with the same name and labels.
+        '''
+        key = (metric.name, _labels(metric.labels))
+        with self._lock:
+            return self._metrics.setdefault(key, metric)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self):
+        '''
+        All metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        described = set()
+        for metric in sorted(self.metrics(), key=lambda metric: metric.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append("# HELP {} {}".format(metric.name, metric.help))
+                lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, _labels(labels), _number(value)))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        for metric in sorted(self.metrics(), key=lambda metric: metric.name):
+            summary = metric.summary()
+            if summary is not None:
+                log.info("%s%s :: %s", metric.name, _labels(metric.labels), summary)
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=None): # pylint: disable=redefined-builtin
+    return REGISTRY.register(Counter(name, help, labels))
+
+def gauge(name, help, func, labels=None): # pylint: disable=redefined-builtin
+    return REGISTRY.register(Gauge(name, help, func, labels))
+
+def gauges(name, help, label, func): # pylint: disable=redefined-builtin
+    return REGISTRY.register(GaugeSet(name, help, label, func))
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, labels=None): # pylint: disable=redefined-builtin
+    return REGISTRY.register(Histogram(name, help, buckets, labels))
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is python 3.7+
+    daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self): # pylint: disable=invalid-name
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+def serve(port, host="127.0.0.1"):
+    '''
+    Serve the metrics on http://host:port/metrics, from a background thread.
+    '''
+    server = _Server((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info("serving metrics on http://%s:%s/metrics", host, server.server_address[1])
+    return server
+
+def start_reporter(interval):
+    '''
+    Log a summary of all metrics every `interval` seconds.
+    '''
+    def _run():
+        while True:
+            time.sleep(interval)
+            REGISTRY.report()
+    threading.Thread(target=_run, name="metrics-report", daemon=True).start()
+
+def start_snapshots(path, interval):
+    '''
+    Write all metrics (in the text format) to `path` every `interval` seconds, for
+    processes that can't scrape us, see supervisor.
+    '''
+    def _run():
+        while True:
+            write_snapshot(path)
+            time.sleep(interval)
+    threading.Thread(target=_run, name="metrics-snapshot", daemon=True).start()
+
+def write_snapshot(path):
+    temp = path + ".tmp"
+    try:
+        with open(temp, "w", encoding="utf-8") as snapshot:
+            snapshot.write(REGISTRY.render())
+        os.replace(temp, path)
+    except OSError as err:
+        log.warning("writing metrics snapshot failed: %s", err)
+
+def parse(text):
+    '''
+    Read samples back from the text format.
+        :returns: dict of (name, labels string) -> value
+    '''
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        sample, _, value = line.rpartition(" ")
+        name, brace, labels = sample.partition("{")
+        try:
+            samples[(name, brace + labels)] = float(value)
+        except ValueError:
+            continue
+    return samples
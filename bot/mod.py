@@ -1,29 +1,56 @@
 import re
+import sys
+from functools import lru_cache
 
 from common import EPSILON, STEAM
 
 class Mod:
+    '''
+    A workshop item in search results. There can be many thousands of these in the
+    caches, so they're slotted, authors are interned, and everything we need to
+    render them is worked out once, when they're created.
+    '''
+    __slots__ = ("title", "url", "author", "profile", "alpha", "includesVersion")
+
     VERSION_REGEX = re.compile(r"\[?([ab]?\d{2}|v?1\.\d)\]?", re.IGNORECASE) # https://regex101.com/r/ICiCxq/2
+    # matches wherever VERSION_REGEX does (everything around the digits is optional), but a lot faster
+    _HAS_VERSION = re.compile(r"\d\d|1\.\d")
 
     def __init__(self, mod, query):
-        self.title = mod['title']
-        self.url = mod['url']
-        self.author = mod['author']
-        self.profile = mod['profile']
-        self.alpha = tagsToAlpha(query.tags)
-                
+        self._fill(mod['title'], mod['url'], mod['author'], mod['profile'], tagsToAlpha(query.tags))
+
+    @classmethod
+    def fromTuple(cls, values, query):
+        '''
+        Inverse of `toTuple`, for mods coming out of a cache or the index.
+        '''
+        mod = cls.__new__(cls)
+        mod._fill(*values, tagsToAlpha(query.tags)) # pylint: disable=protected-access
+        return mod
+
+    def _fill(self, title, url, author, profile, alpha):
+        self.title = title
+        self.url = url
+        self.author = sys.intern(author)
+        self.profile = sys.intern(profile)
+        self.alpha = alpha
+        # note that this regex is hardcoded for 1.x versions, as I don't want to make it too confused to a mod giving itself an x.x version.
+        self.includesVersion = Mod._HAS_VERSION.search(title) is not None
+
     def __repr__(self):
         return "[{}] {} by {} ({}, {})".format(self.alpha, self.title, self.author, self.url, self.profile) 
     
     def __len__(self):
         return 1 
 
-    # note that this regex is hardcoded for 1.x versions, as I don't want to make it too confused to a mod giving itself an x.x version.
     def nameIncludesVersion(self):
-        match = Mod.VERSION_REGEX.search(self.title)
-        if match:
-            return True
-        return False
+        return self.includesVersion
+
+    def toTuple(self):
+        '''
+        Compact form for caches and the index; (title, url, author, profile).
+        '''
+        return (self.title, self.url, self.author, self.profile)
 
     def toObject(self):
         return {
@@ -34,6 +61,11 @@ class Mod:
         }
     
 def tagsToAlpha(tags):
+    # the same few sets of tags come up over and over, and so can share their labels
+    return _alpha(tuple(tags))
+
+@lru_cache(maxsize=64)
+def _alpha(tags):
     # we get Mod/Scenario, and a version tag.
     # Just loop over tags and return the first one that doesn't raise a ValueError...
     for tag in tags:
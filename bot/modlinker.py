@@ -1,8 +1,16 @@
 '''
 This is the main modlinker module. It contains the main script loop, and calls
 the reddit and workshop modules where needed.
+
+The work is split into stages, each with their own worker threads and a bounded
+queue; comments are read and parsed on the main thread, searched for by the search
+stage, replied to by the reply stage, and finally logged by the analytics stage.
 '''
 import logging
+import os
+import signal
+import threading
+import time
 from collections import deque
 
 from commands import ModRequest
@@ -10,70 +18,302 @@ import formatting
 import reddit
 import workshop_scraper as workshop
 import database
-from common import REDDIT
+import metrics
+from checkpoint import Checkpoint
+from common import CHECKPOINT, DATA_DIR, DATABASE, FUZZY, INDEX, MAINTENANCE, METRICS, PIPELINE, PROFILING, REDDIT, REPLIED, SEARCH_RETRY, SHARD
+from pipeline import Pipeline, Stage
+from profiling import Profiler, Trace
+from replied import RepliedIndex
 
-# set up logging
-logging.basicConfig(format='%(module)s :: %(levelname)s :: %(message)s', level=logging.INFO)
 log = logging.getLogger(__name__) # pylint: disable=invalid-name
 
-# start the bot
-# get a comment stream
-stream = reddit.getStream(REDDIT['subreddits']) # pylint: disable=invalid-name
-
-# consume new comments for ever and ever
-for comment in stream.comments():
-    redditor = comment.author.name
-    log.info("new comment :: %s", comment.id)
-    log.debug("%s", comment.body.encode('ascii', 'replace'))
-
-    # skip if made by me
-    if redditor == REDDIT['username']:
-        log.info("comment made by me, skipping")
-        continue
-    
-    # get requests for this post
-    requests = []
-    for request in ModRequest.fromPost(comment.body):
-        requests.append(request)
-
-    # skip if there are no requests for this comments
-    if not requests:
-        log.info("no requests, skipping")
-        continue
-
-    # do a final check to see if we haven't already commented to this request
-    if reddit.hasReplyBy(comment, REDDIT['username']):
-        log.info("already replied to comment, skipping")
-        continue
-
-    # get a queue ready for results
-    parts = deque()
-
-    # for each search term;
-    for request in requests:
-        # get a list of results
-        log.debug( request )
-        mods = workshop.search( request )
-
-        # generate a formatted result table/line, and add it to the queue
-        parts.append( formatting.formatResults(request, mods) )
-
-        # add mod to our 'analytics' database
-        for mod in mods:
-            database.log_mod(redditor, mod)
-
-    # get post(s)
-    posts = formatting.createPosts(parts)
-    for index, post in enumerate(posts):
-        log.debug("reply %s: \n%s", index, post)
-        reply = reddit.handle_ratelimit(comment.reply, post)
+COMMENTS = metrics.counter("modlinker_comments_total", "Comments read")
+REQUESTS = metrics.counter("modlinker_requests_total", "Mod requests found in comments")
+REPLIES = metrics.counter("modlinker_replies_total", "Replies posted")
+PARSE_SECONDS = metrics.histogram("modlinker_parse_seconds", "Time to parse a comment for requests")
+REPLY_CHECK_SECONDS = metrics.histogram("modlinker_reply_check_seconds", "Time to check if we already replied to a comment")
+FORMAT_SECONDS = metrics.histogram("modlinker_format_seconds", "Time to format the results for a comment")
+REPLY_SECONDS = metrics.histogram("modlinker_reply_seconds", "Time to post a reply, including rate limits")
+DEFERRED = metrics.counter("modlinker_deferred_total", "Comments put back because steam was unavailable")
+ABANDONED = metrics.counter("modlinker_abandoned_total", "Comments given up on because steam stayed unavailable")
+
+class Job:
+    '''
+    A comment with requests, as it moves through the stages.
+    '''
+    def __init__(self, comment, redditor, requests, trace=None):
+        self.comment = comment
+        self.redditor = redditor
+        self.requests = requests
+        self.posts = []
+        self.attempts = 0
+        self.trace = trace or Trace()
+
+class ModLinker:
+    def __init__(self):
+        self.profiler = Profiler(PROFILING['directory'], PROFILING['comments'], PROFILING['seconds'])
+        self.search = Stage("search", self.profiler.wrap(self.handle_search), PIPELINE['search_workers'], PIPELINE['queue_size'])
+        self.reply = Stage("reply", self.profiler.wrap(self.handle_reply), PIPELINE['reply_workers'], PIPELINE['queue_size'],
+                           priority=self.reply_priority)
+        self.analytics = Stage("analytics", self.handle_analytics, PIPELINE['analytics_workers'], PIPELINE['queue_size'] * 10)
+        self.pipeline = Pipeline([self.search, self.reply, self.analytics], PIPELINE['report_interval'])
+        self.replied = RepliedIndex(os.path.join(DATA_DIR, "replied.log"), REPLIED['horizon'])
+        self.checkpoint = Checkpoint(os.path.join(DATA_DIR, "checkpoint.json"), CHECKPOINT['save_interval'])
+        self.floor = 0 # comments created before this are not handled
+        self.started = time.time()
+        self.shard = SHARD # (index, count); other workers handle the other comments, see supervisor
+
+    def run(self, comments, backlog=()):
+        '''
+        Consume comments, for ever and ever (or until we're told to stop).
+            :param comments: comment stream
+            :param backlog: comments we missed while down, see `catchup`
+        '''
+        started = self.started = time.time()
+        clock = time.monotonic()
+        skipped = 0
+        steady = False
+        intake = self.profiler.wrap(self.intake, counts=True)
+        self.pipeline.start()
+        try:
+            for comment in backlog:
+                intake(comment)
+            for comment in comments:
+                if not self.owns(comment):
+                    continue
+                # skip anything we've dealt with before a restart, or decided not to catch up on
+                if self.checkpoint.seen(comment) or comment.created_utc < self.floor:
+                    skipped += 1
+                    continue
+                if not steady and comment.created_utc >= started:
+                    steady = True
+                    log.info("caught up with the stream after %.1fs (skipped %s old comments, caught up on %s)",
+                             time.monotonic() - clock, skipped, len(backlog))
+                self.checkpoint.begin(comment)
+                intake(comment)
+        except (KeyboardInterrupt, SystemExit):
+            log.info("shutting down")
+        finally:
+            self.pipeline.drain(PIPELINE['drain_timeout'])
+            self.checkpoint.save()
+
+    def catchup(self, comments):
+        '''
+        Select the comments we missed while we were down from a listing of recent comments,
+        within the catch-up window. Returns them newest first, ready to be passed to `run`.
+        '''
+        self.floor = time.time() - CHECKPOINT['catchup_window']
+        missed = [comment for comment in comments
+                  if self.owns(comment) and not self.checkpoint.seen(comment) and comment.created_utc >= self.floor]
+
+        # register all of them before handling any, so the checkpoint can't move past one we haven't handled yet
+        missed.sort(key=lambda comment: int(comment.id, 36))
+        for comment in missed:
+            self.checkpoint.begin(comment)
+        log.info("catching up on %s missed comments", len(missed))
+        return missed[::-1]
+
+    def owns(self, comment):
+        '''
+        Is this comment ours to handle, or another worker's?
+        '''
+        index, count = self.shard
+        return count <= 1 or int(comment.id, 36) % count == index
+
+    def intake(self, comment):
+        job = self.parse(comment)
+        if job is None:
+            self.checkpoint.done(comment)
+        else:
+            self.search.put(job)
+
+    def parse(self, comment):
+        trace = Trace()
+        redditor = comment.author.name
+        log.info("new comment :: %s", comment.id)
+        log.debug("%s", comment.body.encode('ascii', 'replace'))
+
+        # skip if made by me
+        if redditor == REDDIT['username']:
+            log.info("comment made by me, skipping")
+            return None
+
+        # get requests for this post
+        COMMENTS.inc()
+        with PARSE_SECONDS.time():
+            requests = ModRequest.fromPost(comment.body)
+
+        # skip if there are no requests for this comments
+        if not requests:
+            log.info("no requests, skipping")
+            return None
+
+        REQUESTS.inc(len(requests))
+        trace.mark("parse")
+        return Job(comment, redditor, requests, trace)
+
+    def finish(self, job):
+        '''
+        We're done with this job, one way or another.
+        '''
+        self.checkpoint.done(job.comment)
+        if PROFILING['slow_threshold'] and job.trace.total() >= PROFILING['slow_threshold']:
+            log.warning("slow comment %s, took %.1fs: %s", job.comment.id, job.trace.total(), job.trace)
+
+    def handle_search(self, job):
+        try:
+            self.search_job(job)
+        except Exception:
+            self.finish(job)
+            raise
+
+    def search_job(self, job):
+        # do a final check to see if we haven't already commented to this request
+        job.trace.mark("wait for search")
+        with REPLY_CHECK_SECONDS.time():
+            replied = reddit.hasReplyBy(job.comment, REDDIT['username'], self.replied, REPLIED['refresh'])
+        job.trace.mark("reply check")
+        if replied:
+            log.info("already replied to comment %s, skipping", job.comment.id)
+            self.finish(job)
+            return
+
+        # get a queue ready for results
+        parts = deque()
+
+        # fetch results for all search terms at once
         try:
-            permalink = reply.permalink()
-        except TypeError:
-            permalink = reply.permalink
-        database.log_post(redditor, post, reply.submission.title, permalink)
-        log.info("replied to %s (%s/%s): https://www.reddit.com%s",
-                 comment.id, index+1, len(posts), permalink)
-
-    # done!
-    log.info("Succesfully handled comment %s", comment.id)
+            results = workshop.search_all(job.requests, self.profiler.wrap)
+        except workshop.SearchUnavailable as err:
+            self.defer(job, err)
+            return
+        job.trace.mark("search")
+
+        # for each search term;
+        started = time.perf_counter()
+        for request, mods in zip(job.requests, results):
+            # generate a formatted result table/line, and add it to the queue
+            log.debug( request )
+            parts.append( formatting.formatResults(request, mods) )
+
+        # get post(s)
+        job.posts = formatting.createPosts(parts)
+        FORMAT_SECONDS.observe(time.perf_counter() - started)
+        job.trace.mark("format")
+
+        # add mods to our 'analytics' database
+        for mods in results:
+            for mod in mods:
+                self.analytics.put((database.log_mod, job.redditor, mod))
+        self.reply.put(job)
+
+    def defer(self, job, reason):
+        '''
+        Search again later, steam is unavailable. Waits twice as long every time, and gives up
+        after a few attempts. Until then the comment isn't done, so a restart picks it up again.
+        '''
+        if job.attempts >= SEARCH_RETRY['attempts']:
+            log.warning("giving up on comment %s after %s attempts: %s", job.comment.id, job.attempts + 1, reason)
+            ABANDONED.inc()
+            self.finish(job)
+            return
+        delay = min(SEARCH_RETRY['delay'] * 2 ** job.attempts, SEARCH_RETRY['max_delay'])
+        job.attempts += 1
+        log.info("can't search for comment %s (%s), trying again in %.0fs", job.comment.id, reason, delay)
+        DEFERRED.inc()
+        timer = threading.Timer(delay, self.search.put, (job,))
+        timer.daemon = True
+        timer.start()
+
+    def reply_priority(self, job):
+        '''
+        Replies to fresh comments go before replies to comments we missed while we were down,
+        and short replies before long ones. All parts of a reply are posted in one go, in order.
+        '''
+        return (job.comment.created_utc < self.started, len(job.posts))
+
+    def handle_reply(self, job):
+        try:
+            self.reply_job(job)
+        finally:
+            self.finish(job)
+
+    def reply_job(self, job):
+        comment = job.comment
+        job.trace.mark("wait for reply")
+        for index, post in enumerate(job.posts):
+            log.debug("reply %s: \n%s", index, post)
+            with REPLY_SECONDS.time():
+                reply = reddit.handle_ratelimit(comment.reply, post)
+            REPLIES.inc()
+            self.replied.add(comment.id)
+            try:
+                permalink = reply.permalink()
+            except TypeError:
+                permalink = reply.permalink
+            self.analytics.put((database.log_post, job.redditor, post, reply.submission.title, permalink))
+            log.info("replied to %s (%s/%s): https://www.reddit.com%s",
+                     comment.id, index+1, len(job.posts), permalink)
+
+        # done!
+        job.trace.mark("reply")
+        log.info("Succesfully handled comment %s", comment.id)
+
+    @staticmethod
+    def handle_analytics(record):
+        func, *args = record
+        func(*args)
+
+def _terminate(signum, frame): # pylint: disable=unused-argument
+    raise SystemExit(signum)
+
+if __name__ == '__main__':
+    # set up logging
+    logging.basicConfig(format='%(module)s :: %(levelname)s :: %(message)s', level=logging.INFO)
+
+    # docker stops us with a SIGTERM, drain the pipeline before going down.
+    signal.signal(signal.SIGTERM, _terminate)
+
+    # metrics, on a local endpoint and/or in the log
+    if METRICS['port']:
+        metrics.serve(METRICS['port'], METRICS['host'])
+    if METRICS['report_interval'] > 0:
+        metrics.start_reporter(METRICS['report_interval'])
+    if METRICS['snapshot']:
+        metrics.start_snapshots(METRICS['snapshot'], METRICS['snapshot_interval'])
+
+    # keep the offline workshop index up to date, or follow the worker that does
+    if INDEX['enabled']:
+        if MAINTENANCE:
+            workshop.start_crawler()
+        else:
+            workshop.follow_index()
+
+    # top N queries on the counters need their indexes
+    if MAINTENANCE:
+        database.ensure_indexes()
+
+    # move old records out of the database, see database.archive
+    if MAINTENANCE and DATABASE['archive']['interval'] > 0:
+        database.start_archiver()
+
+    # learn the mod titles we've linked before, to correct misspelled requests
+    if FUZZY['seed']:
+        workshop.seed_matcher(database.known_titles)
+
+    # start the bot
+    # get a comment stream, and whatever we missed while we were away
+    subreddit = reddit.getSubreddit(REDDIT['subreddits']) # pylint: disable=invalid-name
+    bot = ModLinker() # pylint: disable=invalid-name
+
+    # `kill -USR1` to profile a while, see profiling
+    bot.profiler.install()
+    if PROFILING['at_start']:
+        bot.profiler.start()
+    backlog = [] # pylint: disable=invalid-name
+    if CHECKPOINT['catchup_window'] > 0:
+        backlog = bot.catchup(subreddit.comments(limit=CHECKPOINT['catchup_limit']))
+    try:
+        bot.run(subreddit.stream.comments(), backlog)
+    finally:
+        database.close()
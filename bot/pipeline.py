@@ -0,0 +1,145 @@
+'''
+Bounded-queue worker stages, so that a slow part of the bot (e.g. waiting out a
+rate limit) doesn't block all the others.
+'''
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# sentinel telling a worker to stop
+_STOP = object()
+
+class Stage:
+    '''
+    A pool of worker threads, handling items from a bounded queue. `put` blocks
+    while the queue is full, so a slow stage pushes back on the stages feeding it.
+
+    Items are handled in the order they were put in, unless a `priority` function
+    is given; then the item with the lowest priority goes first (and items with
+    the same priority in the order they were put in).
+    '''
+    def __init__(self, name, handler, workers=1, maxsize=100, priority=None):
+        self.name = name
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.priority = priority
+        self.queue = queue.PriorityQueue(maxsize) if priority else queue.Queue(maxsize)
+        self._order = itertools.count()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.started = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self._seconds = metrics.histogram("modlinker_stage_seconds", "Time to handle an item", labels={"stage": name})
+        self._wait = metrics.histogram("modlinker_stage_wait_seconds", "Time an item was queued for", labels={"stage": name})
+        metrics.gauge("modlinker_stage_queue_depth", "Items waiting to be handled", self.queue.qsize, labels={"stage": name})
+
+    def start(self):
+        self.started = time.monotonic()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name="{}-{}".format(self.name, index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item):
+        priority = self.priority(item) if self.priority else 0
+        self.queue.put((False, priority, next(self._order), time.monotonic(), item))
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def drain(self, timeout=None):
+        '''
+        Handle everything that is still queued, then stop the workers.
+        '''
+        for _ in self._threads:
+            # stop after everything else
+            self.queue.put((True, 0, next(self._order), time.monotonic(), _STOP))
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        if self._threads:
+            log.warning("%s stage did not drain in time, %s items left", self.name, self.queue.qsize())
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "wait": self.waited / self.processed if self.processed else 0.0,
+            "throughput": self.processed / elapsed if elapsed else 0.0,
+            "utilization": self.busy / (elapsed * self.workers) if elapsed else 0.0
+        }
+
+    def _work(self):
+        while True:
+            _, _, _, queued, item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                start = time.monotonic()
+                self._wait.observe(start - queued)
+                try:
+                    self.handler(item)
+                except Exception as exc: # pylint: disable=broad-except
+                    log.exception("unhandled %s in %s stage: %s", type(exc).__name__, self.name, exc)
+                    with self._lock:
+                        self.failed += 1
+                elapsed = time.monotonic() - start
+                self._seconds.observe(elapsed)
+                with self._lock:
+                    self.processed += 1
+                    self.busy += elapsed
+                    self.waited += start - queued
+            finally:
+                self.queue.task_done()
+
+class Pipeline:
+    '''
+    A chain of stages, started together and drained in order.
+    '''
+    def __init__(self, stages, report_interval=300):
+        self.stages = stages
+        self.report_interval = report_interval
+        self._stopped = threading.Event()
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        if self.report_interval:
+            threading.Thread(target=self._report_loop, name="pipeline-report", daemon=True).start()
+
+    def drain(self, timeout=None):
+        '''
+        Stop each stage in turn, after it has handled everything handed to it by the stages before it.
+        '''
+        self._stopped.set()
+        for stage in self.stages:
+            log.info("draining %s stage (%s queued)", stage.name, stage.queue.qsize())
+            stage.drain(timeout)
+        self.report()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def report(self):
+        for name, stats in self.stats().items():
+            log.info("%s :: queue %s (max %s), %s done (%.2f/s, %.1fs queued on average), %s failed, %.0f%% busy",
+                     name, stats['depth'], stats['max_depth'], stats['processed'], stats['throughput'],
+                     stats['wait'], stats['failed'], stats['utilization'] * 100)
+
+    def _report_loop(self):
+        while not self._stopped.wait(self.report_interval):
+            self.report()
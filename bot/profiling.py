@@ -0,0 +1,201 @@
+'''
+Profiling on demand, for when the bot falls behind and we want to know why
+without redeploying it.
+
+A `Profiler` wraps the per-comment handlers. While a session is running, each
+call is run under cProfile (one profile per thread, since cProfile only sees the
+thread it's enabled on), until `comments` comments have been handled or `seconds`
+have passed. The per-thread profiles are then combined, and written to a
+timestamped `.prof` file (for `pstats` or snakeviz), with a plain text summary
+next to it. Sessions are started and stopped with SIGUSR1, see `install`; the
+signal handler only hands the toggle to a helper thread, since the main thread
+may be in the middle of a profiled call (holding the profiler's lock) when the
+signal comes in.
+
+`Trace` is the cheap, always-on alternative; it records how long each step of
+handling a comment took, so slow comments can be logged with a breakdown.
+'''
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import threading
+import time
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+class _Session:
+    def __init__(self, comments, seconds):
+        self.comments = comments
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.started = time.time()
+        self.handled = 0
+        self.active = 0
+        self.stopped = False
+        self.written = False
+        self.profiles = {}
+
+class Profiler:
+    def __init__(self, directory, comments=200, seconds=300):
+        '''
+            :param directory: where to write profiles
+            :param comments: default number of comments to profile for
+            :param seconds: default number of seconds to profile for
+        '''
+        self.directory = directory
+        self.comments = comments
+        self.seconds = seconds
+        self._session = None
+        self._lock = threading.Lock()
+        self._toggle = threading.Event()
+
+    @property
+    def running(self):
+        return self._session is not None and not self._session.stopped
+
+    def start(self, comments=None, seconds=None):
+        '''
+        Start profiling for `comments` comments or `seconds` seconds, whichever comes first (0 for no limit).
+        '''
+        comments = self.comments if comments is None else comments
+        seconds = self.seconds if seconds is None else seconds
+        with self._lock:
+            if self.running:
+                return
+            self._session = _Session(comments, seconds)
+        log.info("profiling for %s comments or %ss", comments or "any number of", seconds or "ever")
+        if seconds:
+            timer = threading.Timer(seconds, self.stop)
+            timer.daemon = True
+            timer.start()
+
+    def stop(self):
+        with self._lock:
+            session = self._session
+            if session is None or session.stopped:
+                return
+            session.stopped = True
+            # if handlers are still busy, the last one to finish writes the profile
+            write = self._claim(session)
+        if write:
+            threading.Thread(target=self._write, args=(session,), name="profile-writer", daemon=True).start()
+
+    def toggle(self, *args): # pylint: disable=unused-argument
+        '''
+        Start a session if there isn't one running, stop it otherwise.
+        '''
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def install(self, signum=getattr(signal, "SIGUSR1", None)):
+        '''
+        Toggle profiling with a signal (`kill -USR1 <pid>`). Must be called from the main thread.
+        '''
+        if signum is None:
+            log.warning("no signal to toggle profiling with on this platform")
+            return
+        threading.Thread(target=self._watch, name="profile-toggle", daemon=True).start()
+        signal.signal(signum, self._signal)
+
+    def _signal(self, signum, frame): # pylint: disable=unused-argument
+        # don't take the lock here, the main thread might already hold it
+        self._toggle.set()
+
+    def _watch(self):
+        while True:
+            self._toggle.wait()
+            self._toggle.clear()
+            try:
+                self.toggle()
+            except Exception as exc: # pylint: disable=broad-except
+                log.exception(exc)
+
+    def wrap(self, handler, counts=False):
+        '''
+        Wrap a handler, so that calls are profiled while a session is running.
+            :param counts: calls to this handler count towards the session's comment limit
+        '''
+        def _profiled(*args, **kwargs):
+            with self._lock:
+                session = self._session
+                if session is None or session.stopped:
+                    session = None
+                else:
+                    session.active += 1
+                    profile = session.profiles.setdefault(threading.get_ident(), cProfile.Profile())
+            if session is None:
+                return handler(*args, **kwargs)
+            try:
+                profile.enable()
+                try:
+                    return handler(*args, **kwargs)
+                finally:
+                    profile.disable()
+            finally:
+                self._finish_call(session, counts)
+        return _profiled
+
+    def _finish_call(self, session, counts):
+        with self._lock:
+            session.active -= 1
+            if counts:
+                session.handled += 1
+            if (session.comments and session.handled >= session.comments) or (
+                    session.deadline and time.monotonic() >= session.deadline):
+                session.stopped = True
+            write = self._claim(session)
+        if write:
+            self._write(session)
+
+    @staticmethod
+    def _claim(session):
+        # call with the lock held; is it time to write the profile, and are we the one to do it?
+        if session.stopped and session.active == 0 and not session.written:
+            session.written = True
+            return True
+        return False
+
+    def _write(self, session):
+        profiles = list(session.profiles.values())
+        if not profiles:
+            log.info("profiling stopped, nothing was handled")
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "profile-{}".format(time.strftime("%Y%m%d-%H%M%S", time.gmtime(session.started))))
+        stats.dump_stats(path + ".prof")
+        summary = io.StringIO()
+        summary.write("{} comments on {} threads over {:.1f}s\n\n".format(
+            session.handled, len(profiles), time.time() - session.started))
+        pstats.Stats(path + ".prof", stream=summary).sort_stats("cumulative").print_stats(40)
+        with open(path + ".txt", "w", encoding="utf-8") as text:
+            text.write(summary.getvalue())
+        log.info("profiled %s comments, written to %s.prof", session.handled, path)
+
+class Trace:
+    '''
+    Time spent on each step of handling a comment. Call `mark` at the end of each step.
+    '''
+    __slots__ = ("start", "last", "steps")
+
+    def __init__(self):
+        self.start = self.last = time.monotonic()
+        self.steps = []
+
+    def mark(self, step):
+        now = time.monotonic()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    def __str__(self):
+        return ", ".join("{} {:.0f}ms".format(step, seconds * 1000) for step, seconds in self.steps)
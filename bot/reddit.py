@@ -1,22 +1,42 @@
 import logging
-import time
 
 import praw
 
-from common import REDDIT
+import metrics
+from common import REDDIT, REPLY
+from scheduler import TokenBucket, parse_wait
 
 log = logging.getLogger(__name__) # pylint: disable=invalid-name
 
-def hasReplyBy( comment, username ):
+REFRESHES = metrics.counter("modlinker_comment_refreshes_total", "Comments refreshed to look for our replies")
+RATELIMITS = metrics.counter("modlinker_ratelimits_total", "Rate limit errors from reddit")
+RATELIMIT_SLEEP = metrics.counter("modlinker_ratelimit_sleep_seconds_total", "Time spent waiting out rate limits")
+RETRIES = metrics.histogram("modlinker_reply_retries", "Attempts per call beyond the first", (0, 1, 2, 3, 5, 10))
+
+# shared by everything that posts to reddit
+LIMITER = TokenBucket(REPLY['per_minute'], REPLY['burst'])
+
+def hasReplyBy( comment, username, index = None, refresh = True ):
     """
     Returns true if `comment` has a first-level reply made by `username`.
         :param comment: reddit.Comment
         :param username: string username
+        :param index: optional RepliedIndex of comments `username` has replied to
+        :param refresh: ask reddit for comments that are too old for the index to know about
     """
+    # the index knows about all our replies to comments created within its horizon,
+    # so only go and ask reddit about comments older than that.
+    if index is not None:
+        if comment.id in index:
+            return True
+        if not refresh or index.covers(comment.created_utc):
+            return False
+
     # refresh has a nasty tendency to fail on fresh posts.
     # since this is really only meant to avoid duplication on a restart of the script,
     # and fresh posts are unlikely to have replies, just assume we haven't replied yet.
     # TODO: Selectively catch, raise other errors.
+    REFRESHES.inc()
     try:
         comment.refresh()
     except Exception as error:
@@ -31,22 +51,35 @@ def hasReplyBy( comment, username ):
 
 def handle_ratelimit(func, *args, **kwargs):
     '''
-    If we encounter a rate limit exception, sleep for a while and then try again.
+    Call `func` when the rate limiter says we may. If we still encounter a rate limit
+    exception, hold off all calls for as long as reddit tells us to, and then try again.
     https://gist.github.com/bboe/1860715
     '''
+    retries = 0
     while True:
+        RATELIMIT_SLEEP.inc( LIMITER.acquire() )
         try:
-            return func(*args, **kwargs)
+            result = func(*args, **kwargs)
+            RETRIES.observe( retries )
+            return result
         except praw.exceptions.APIException as error:
             if error.error_type == "RATELIMIT":
-                log.warning( "rate limit exceeded. Sleeping for 5 seconds." )
+                wait = parse_wait( error.message )
+                if wait is None:
+                    wait = REPLY['default_wait']
+                log.warning( "rate limit exceeded. Holding off for %s seconds.", wait )
                 log.info( error.message )
-                time.sleep( 5 )
+                RATELIMITS.inc()
+                LIMITER.pause( wait )
+                retries += 1
             else:
                 raise
 
+def getSubreddit( reddits ):
+    return praw.Reddit( **REDDIT ).subreddit( reddits )
+
 def getStream( reddits ):
-    return praw.Reddit( **REDDIT ).subreddit( reddits ).stream
+    return getSubreddit( reddits ).stream
 
 if __name__ == '__main__':
     print(REDDIT)
@@ -0,0 +1,100 @@
+'''
+Local, persistent index of the comments we've replied to, so we don't need to ask
+reddit whether we've already replied to a comment.
+'''
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+class RepliedIndex:
+    '''
+    Set of comment ids we've replied to, with the time of the reply.
+
+    On disk this is an append-only file of `<comment id> <unix time>` lines, so
+    recording a reply is a single small write. The first line records when the
+    index was started; replies older than `horizon` seconds are pruned, so the
+    index can vouch for comments created after both of those points in time.
+    '''
+    def __init__(self, path, horizon=7*24*60*60, prune_every=1000):
+        self.path = path
+        self.horizon = horizon
+        self.prune_every = prune_every
+        self.since = None
+        self._replied = {}
+        self._added = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._load()
+        self.prune()
+
+    def __contains__(self, comment_id):
+        return comment_id in self._replied
+
+    def __len__(self):
+        return len(self._replied)
+
+    def covers(self, created):
+        '''
+        Would a reply to a comment created at `created` (unix time) be in the index?
+        '''
+        return created >= max(self.since, time.time() - self.horizon)
+
+    def add(self, comment_id, when=None):
+        '''
+        Record a reply to `comment_id`. This is written to disk before returning.
+        '''
+        when = int(when or time.time())
+        with self._lock:
+            if comment_id in self._replied:
+                return
+            self._replied[comment_id] = when
+            with open(self.path, "a", encoding="ascii") as index:
+                index.write("{} {}\n".format(comment_id, when))
+                index.flush()
+                os.fsync(index.fileno())
+            self._added += 1
+        if self._added % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        '''
+        Drop replies older than the horizon, and compact the file.
+        '''
+        cutoff = time.time() - self.horizon
+        with self._lock:
+            before = len(self._replied)
+            self._replied = {comment_id: when for comment_id, when in self._replied.items() if when >= cutoff}
+            temp = self.path + ".tmp"
+            with open(temp, "w", encoding="ascii") as index:
+                index.write("since {}\n".format(int(self.since)))
+                index.writelines("{} {}\n".format(comment_id, when) for comment_id, when in self._replied.items())
+                index.flush()
+                os.fsync(index.fileno())
+            os.replace(temp, self.path)
+        if before > len(self._replied):
+            log.info("pruned %s replies from the replied index", before - len(self._replied))
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="ascii") as index:
+                for line in index:
+                    key, _, value = line.strip().partition(" ")
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        # a line torn by a crash mid-write, skip it
+                        continue
+                    if key == "since":
+                        self.since = value
+                    else:
+                        self._replied[key] = value
+        except FileNotFoundError:
+            pass
+        if self.since is None:
+            self.since = int(time.time())
+        log.info("loaded %s replies from %s", len(self._replied), self.path)
@@ -0,0 +1,75 @@
+'''
+Scheduling of replies around reddit's rate limits.
+
+Instead of trying a reply every few seconds until reddit stops saying RATELIMIT,
+replies take a token from a bucket that refills at the rate we're allowed to post
+at. When reddit does tell us to back off, it says for how long ("try again in 6
+minutes"), so the bucket is paused for exactly that long, and nobody tries again
+before then.
+'''
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+_WAIT = re.compile(r"(\d+)\s*(milliseconds?|ms|seconds?|minutes?|hours?)", re.IGNORECASE)
+_UNITS = {"ms": 0.001, "millisecond": 0.001, "second": 1, "minute": 60, "hour": 60*60}
+
+def parse_wait(message):
+    '''
+    Seconds to wait according to a RATELIMIT message, e.g.
+    "you are doing that too much. try again in 6 minutes.", or None if it doesn't say.
+    '''
+    match = _WAIT.search(message or "")
+    if not match:
+        return None
+    unit = match.group(2).lower()
+    unit = unit if unit == "ms" else unit.rstrip("s")
+    return int(match.group(1)) * _UNITS[unit]
+
+class TokenBucket:
+    '''
+    Allows `per_minute` calls per minute on average, with bursts of up to `burst`
+    calls. Callers reserve a slot with `acquire`, which sleeps until it's their turn,
+    so waiting callers go in the order they arrived. `pause` stops everyone for a while.
+    With `per_minute` 0 there's no limit other than pauses.
+    '''
+    def __init__(self, per_minute=0, burst=1):
+        self.interval = 60 / per_minute if per_minute else 0.0
+        self.tolerance = self.interval * (max(burst, 1) - 1)
+        self.paused_until = 0.0
+        self.waited = 0.0
+        self._next = 0.0 # theoretical time of the next call, if calls were evenly spaced
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Wait for our turn.
+            :returns: seconds waited
+        '''
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next - self.tolerance, self.paused_until)
+            self._next = max(self._next, start) + self.interval
+        waited = 0.0
+        while start > now:
+            time.sleep(start - now)
+            waited += start - now
+            # we may have been paused while we slept
+            now = time.monotonic()
+            start = self.paused_until
+        with self._lock:
+            self.waited += waited
+        return waited
+
+    def pause(self, seconds):
+        '''
+        Nobody gets a turn for the next `seconds` seconds.
+        '''
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self.paused_until:
+                self.paused_until = until
+                self._next = max(self._next, until)
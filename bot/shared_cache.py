@@ -0,0 +1,132 @@
+'''
+Search results cache on disk, shared between worker processes (see supervisor),
+so that a search done by one worker is a cache hit for all of them.
+
+It's a second tier behind the in-process `cache.SearchCache`; results live in an
+sqlite database in WAL mode, so workers can read while another one writes. Times
+are wall clock, since monotonic clocks aren't comparable between processes.
+'''
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from cache import cache_key
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    mods TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    complete INTEGER NOT NULL,
+    expires REAL NOT NULL
+)'''
+
+def _key(request):
+    return json.dumps(cache_key(request), ensure_ascii=False)
+
+class SharedCache:
+    '''
+    Search results by normalized request, with the same TTLs (and stale window) as
+    `cache.SearchCache`. Mods are stored in their compact form, see `Mod.toTuple`.
+    '''
+    def __init__(self, path, ttl=6*60*60, negative_ttl=5*60, stale=24*60*60, timeout=5.0):
+        '''
+            :param path: sqlite database file, created if needed
+            :param timeout: seconds to wait for another process to finish writing
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale = stale
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(_SCHEMA)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, so every thread gets its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, request, stale=False):
+        '''
+        Get cached results for a ModRequest, if we have enough of them and they haven't expired.
+            :param stale: accept expired results (within the stale window), even if there are fewer than requested
+            :returns: (list of mod tuples, True if that's all there is, seconds until they expire), or None
+        '''
+        now = time.time()
+        try:
+            row = self._connection().execute(
+                "SELECT mods, count, complete, expires FROM results WHERE key = ?", (_key(request),)).fetchone()
+        except sqlite3.Error as err:
+            log.warning("reading shared cache failed: %s", err)
+            with self._lock:
+                self.errors += 1
+            return None
+
+        usable = row is not None and (
+            (stale and row[1] and row[3] + self.stale > now)
+            or (not stale and row[3] > now and (row[2] or row[1] >= request.count)))
+        with self._lock:
+            if usable:
+                self.hits += 1
+            elif not stale:
+                self.misses += 1
+        if not usable:
+            return None
+        return json.loads(row[0]), bool(row[2]), row[3] - now
+
+    def put(self, request, mods, complete=False):
+        '''
+        Cache the results for a ModRequest.
+            :param mods: list of Mod
+            :param complete: True if `mods` holds all the results there are for this query
+        '''
+        mods = [mod.toTuple() for mod in mods]
+        complete = complete or not mods
+        expires = time.time() + (self.ttl if mods else self.negative_ttl)
+        key = _key(request)
+        try:
+            connection = self._connection()
+            with connection:
+                # take the write lock up front, so no other worker can slip in between the check and the write
+                connection.execute("BEGIN IMMEDIATE")
+                current = connection.execute("SELECT count, complete, expires FROM results WHERE key = ?", (key,)).fetchone()
+                # like the in-process cache, don't replace live results that can answer more than these
+                if (current is not None and current[2] > time.time() and not complete
+                        and (current[1] or current[0] > len(mods))):
+                    return
+                connection.execute("INSERT OR REPLACE INTO results (key, mods, count, complete, expires) VALUES (?, ?, ?, ?, ?)",
+                                   (key, json.dumps(mods), len(mods), int(complete), expires))
+        except sqlite3.Error as err:
+            log.warning("writing shared cache failed: %s", err)
+            with self._lock:
+                self.errors += 1
+
+    def prune(self):
+        '''
+        Remove results that are past their stale window.
+            :returns: number of results removed
+        '''
+        with self._connection() as connection:
+            return connection.execute("DELETE FROM results WHERE expires + ? <= ?", (self.stale, time.time())).rowcount
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
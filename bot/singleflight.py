@@ -0,0 +1,88 @@
+'''
+Coalescing of identical concurrent calls, so that a popular request only costs
+one call to the service behind it.
+'''
+import logging
+import threading
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    '''
+    The first caller for a key makes the call, everyone that asks for the same key
+    while it's in flight waits for it and gets the same result (or exception).
+    Results aren't kept once the call is done; that's what the cache is for.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.deduplicated = 0
+        self.uncovered = 0
+        self.waiting = 0
+        self.max_waiters = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, covers=None):
+        '''
+        Call `func`, unless there's already a call in flight for `key`, then wait for that one.
+            :param covers: function telling whether a shared result is good enough for this caller;
+                           if not, the caller makes its own call after all
+            :returns: (result, True if it was shared)
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                call.waiters += 1
+                self.waiting += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+
+        if leader:
+            try:
+                call.result = func()
+                return call.result, False
+            except BaseException as err:
+                call.error = err
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        call.done.wait()
+        with self._lock:
+            self.waiting -= 1
+        if call.error is not None:
+            raise call.error
+        if covers is not None and not covers(call.result):
+            log.debug("%s: shared result for %s doesn't cover this call, making our own", self.name, key)
+            with self._lock:
+                self.uncovered += 1
+                self.calls += 1
+            return func(), False
+        with self._lock:
+            self.deduplicated += 1
+        return call.result, True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "deduplicated": self.deduplicated,
+                "uncovered": self.uncovered,
+                "waiting": self.waiting,
+                "max_waiters": self.max_waiters
+            }
@@ -0,0 +1,242 @@
+'''
+Supervisor mode; runs several modlinker workers as separate processes, so the bot
+can use more than one core.
+
+The work is split in one of two ways (MODLINKER_PARTITION):
+ - subreddit: the subreddits we listen to ("a+b+c") are dealt out over the workers,
+   and each worker only streams its own. Cheapest on the reddit API, but the load is
+   only as even as the subreddits are busy, and there's never more workers than
+   subreddits.
+ - hash: every worker streams all subreddits, but only handles the comments whose
+   id modulo the number of workers is its index, see `ModLinker.owns`.
+
+Every worker gets its own data directory (checkpoint, replied index, journal) under
+DATA_DIR, and they share a search cache on disk, see shared_cache. Only the first
+worker crawls the workshop index, creates the database indexes and archives old
+records; the others load the index it saves. Workers that die
+are restarted, backing off if they keep dying, and the throughput of each worker is
+logged every so often, from the metrics snapshots they write.
+
+    MODLINKER_WORKERS=4 MODLINKER_PARTITION=hash python supervisor.py
+'''
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import metrics
+from common import CACHE, DATA_DIR, DATABASE, INDEX, METRICS, PIPELINE, REDDIT, SUPERVISOR
+from shared_cache import SharedCache
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def partition(subreddits, workers, mode="subreddit"):
+    '''
+    Split the work between workers.
+        :param subreddits: what we listen to, as a multireddit ("a+b+c")
+        :returns: list of environment variables to set, one dict per worker
+    '''
+    if mode == "subreddit":
+        names = [name for name in subreddits.split("+") if name]
+        workers = max(min(workers, len(names)), 1)
+        return [{"REDDIT_LISTEN_TO": "+".join(names[index::workers])} for index in range(workers)]
+    if mode == "hash":
+        return [{"MODLINKER_SHARD": "{}/{}".format(index, workers)} for index in range(workers)]
+    raise ValueError("unknown partition mode: {}".format(mode))
+
+class Worker:
+    '''
+    A modlinker process, and what we know about it.
+    '''
+    def __init__(self, index, env):
+        self.index = index
+        self.name = "worker-{}".format(index)
+        # workers run in HERE, which needn't be where we were started
+        self.data_dir = os.path.abspath(os.path.join(DATA_DIR, self.name))
+        self.snapshot = os.path.join(self.data_dir, "metrics.prom")
+        self.env = dict(env, MODLINKER_DATA=self.data_dir, MODLINKER_METRICS_SNAPSHOT=self.snapshot)
+        self.process = None
+        self.started = 0.0
+        self.crashes = 0 # in a row
+        self.restarts = 0
+        self.restart_at = None
+        self.last = None # (time, counts) at the last report
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def uptime(self):
+        return time.monotonic() - self.started
+
+    def start(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        # don't count what the previous process did towards this one
+        if os.path.exists(self.snapshot):
+            os.remove(self.snapshot)
+        self.process = subprocess.Popen([sys.executable, os.path.join(HERE, "modlinker.py")], cwd=HERE, env=self.env,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.started = time.monotonic()
+        self.restart_at = None
+        self.last = None
+        threading.Thread(target=self._forward, args=(self.process.stdout,), name=self.name + "-output", daemon=True).start()
+        log.info("started %s (pid %s)", self.name, self.process.pid)
+
+    def _forward(self, output):
+        # the workers log to stdout, prefix their lines so we can tell them apart
+        prefix = (self.name + " :: ").encode("utf-8")
+        for line in output:
+            sys.stdout.buffer.write(prefix + line)
+            sys.stdout.buffer.flush()
+
+    def counts(self):
+        '''
+        Totals from the worker's latest metrics snapshot.
+        '''
+        try:
+            with open(self.snapshot, encoding="utf-8") as snapshot:
+                samples = metrics.parse(snapshot.read())
+        except OSError:
+            samples = {}
+        return {name: samples.get(("modlinker_{}_total".format(name), ""), 0.0)
+                for name in ("comments", "requests", "replies")}
+
+class Supervisor:
+    def __init__(self, workers, shared_cache=None):
+        '''
+            :param workers: list of Worker
+            :param shared_cache: SharedCache the workers use, to prune every now and then
+        '''
+        self.workers = workers
+        self.shared_cache = shared_cache
+        for worker in workers:
+            labels = {"worker": worker.name}
+            metrics.gauge("modlinker_worker_up", "1 while the worker is running", lambda worker=worker: int(worker.alive), labels)
+            metrics.gauge("modlinker_worker_restarts", "Times the worker was restarted", lambda worker=worker: worker.restarts, labels)
+
+    def run(self):
+        '''
+        Start the workers, and keep them running until we're told to stop.
+        '''
+        for worker in self.workers:
+            worker.start()
+        next_report = time.monotonic() + SUPERVISOR['report_interval']
+        try:
+            while True:
+                for worker in self.workers:
+                    self.check(worker)
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report += SUPERVISOR['report_interval']
+                time.sleep(1)
+        except (KeyboardInterrupt, SystemExit):
+            log.info("shutting down")
+        finally:
+            # each worker drains its stages one after the other
+            self.stop(PIPELINE['drain_timeout'] * 3 + 10)
+
+    def check(self, worker):
+        '''
+        Restart the worker if it died, after a delay that grows while it keeps dying.
+        '''
+        if worker.alive:
+            if worker.crashes and worker.uptime >= SUPERVISOR['stable']:
+                worker.crashes = 0
+            return
+        if worker.restart_at is None:
+            delay = min(SUPERVISOR['restart_delay'] * 2 ** worker.crashes, SUPERVISOR['max_restart_delay'])
+            worker.crashes += 1
+            worker.restart_at = time.monotonic() + delay
+            log.warning("%s exited with %s after %.0fs, restarting in %.0fs",
+                        worker.name, worker.process.returncode, worker.uptime, delay)
+        elif time.monotonic() >= worker.restart_at:
+            worker.restarts += 1
+            worker.start()
+
+    def report(self):
+        '''
+        Log the throughput of every worker since the last report.
+        '''
+        now = time.monotonic()
+        totals = dict.fromkeys(("comments", "requests", "replies"), 0.0)
+        for worker in self.workers:
+            counts = worker.counts()
+            since, before = worker.last or (worker.started, dict.fromkeys(counts, 0.0))
+            seconds = max(now - since, 1e-9)
+            # a worker that was restarted starts counting from zero again
+            rates = {name: (count - before[name] if count >= before[name] else count) / seconds
+                     for name, count in counts.items()}
+            worker.last = now, counts
+            for name, rate in rates.items():
+                totals[name] += rate
+            log.info("%s: %s, %.2f comments/s, %.2f requests/s, %.1f replies/min, %s restarts",
+                     worker.name, "up {:.0f}s".format(worker.uptime) if worker.alive else "down",
+                     rates['comments'], rates['requests'], rates['replies'] * 60, worker.restarts)
+        log.info("all workers: %.2f comments/s, %.2f requests/s, %.1f replies/min",
+                 totals['comments'], totals['requests'], totals['replies'] * 60)
+        if self.shared_cache is not None:
+            pruned = self.shared_cache.prune()
+            if pruned:
+                log.info("pruned %s expired results from the shared cache", pruned)
+
+    def forward(self, signum, frame): # pylint: disable=unused-argument
+        '''
+        Pass a signal on to all workers (e.g. SIGUSR1, to toggle profiling).
+        '''
+        for worker in self.workers:
+            if worker.alive:
+                worker.process.send_signal(signum)
+
+    def stop(self, timeout):
+        '''
+        Ask all workers to stop, and kill the ones that haven't after `timeout` seconds.
+        '''
+        for worker in self.workers:
+            if worker.alive:
+                worker.process.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                log.warning("%s didn't stop in time, killing it", worker.name)
+                worker.process.kill()
+                worker.process.wait()
+
+def _terminate(signum, frame): # pylint: disable=unused-argument
+    raise SystemExit(signum)
+
+def main():
+    logging.basicConfig(format='supervisor :: %(module)s :: %(levelname)s :: %(message)s', level=logging.INFO)
+    signal.signal(signal.SIGTERM, _terminate)
+
+    shared_path = os.path.abspath(os.path.join(DATA_DIR, "search_cache.sqlite"))
+    shared_cache = SharedCache(shared_path, CACHE['ttl'], CACHE['negative_ttl'], CACHE['stale'])
+    parts = partition(REDDIT['subreddits'], SUPERVISOR['workers'], SUPERVISOR['partition'])
+    workers = []
+    for index, part in enumerate(parts):
+        env = dict(os.environ, MODLINKER_SHARED_CACHE=shared_path, MODLINKER_INDEX_PATH=os.path.abspath(INDEX['path']),
+                   MODLINKER_DB_ARCHIVE_DIR=os.path.abspath(DATABASE['archive']['directory']),
+                   MODLINKER_MAINTENANCE="yes" if index == 0 else "no", **part)
+        # every worker serves its own metrics on the next port up
+        env['MODLINKER_METRICS_PORT'] = str(METRICS['port'] + 1 + index if METRICS['port'] else 0)
+        workers.append(Worker(index, env))
+    log.info("running %s workers, partitioned by %s", len(workers), SUPERVISOR['partition'])
+
+    if METRICS['port']:
+        metrics.serve(METRICS['port'], METRICS['host'])
+    supervisor = Supervisor(workers, shared_cache)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, supervisor.forward)
+    supervisor.run()
+
+if __name__ == '__main__':
+    main()
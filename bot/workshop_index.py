@@ -0,0 +1,311 @@
+'''
+Offline index of workshop items, so that most requests can be answered without
+a live search on steam.
+
+The index holds the title, url, author, profile and tags of each item, and is
+stored on disk as gzipped JSON. Searches use an inverted index of title words,
+ranked with BM25 and filtered by tags. It is kept up to date by a background
+crawler that walks the workshop browse pages.
+
+Run this module to build an index from the saved pages in fixtures/workshop,
+and try a few searches against it.
+'''
+import glob
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from cache import normalize
+
+log = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+FORMAT_VERSION = 1
+_WORD = re.compile(r"\w+")
+_ID = re.compile(r"[?&]id=(\d+)")
+
+# BM25 parameters
+_K1 = 1.2
+_B = 0.75
+
+def tokenize(text):
+    return _WORD.findall(normalize(text))
+
+def item_id(url):
+    match = _ID.search(url)
+    return match.group(1) if match else url
+
+class WorkshopIndex:
+    def __init__(self, mod_url=None):
+        '''
+            :param mod_url: format string for canonical item urls, with an {id} placeholder
+        '''
+        self.mod_url = mod_url
+        self.updated = 0.0 # time of the last crawl that covered everything, see `IndexCrawler`
+        self.progress = {} # browse page to carry on from per set of tags, None once crawled to the end
+        self._docs = []
+        self._ids = {}
+        self._postings = {}
+        self._lengths = []
+        self._total_length = 0 # sum of _lengths, for the average document length
+        self._tags = {}
+        self._titles = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def titles(self):
+        with self._lock:
+            return [doc[0] for doc in self._docs]
+
+    def stale(self, max_age):
+        return time.time() - self.updated > max_age
+
+    def add(self, mod, tags):
+        '''
+        Add a scraped item (dict with title, url, author and profile) with the given tags.
+            :returns: True if this item wasn't in the index yet
+        '''
+        key = item_id(mod['url'])
+        with self._lock:
+            doc = self._ids.get(key)
+            if doc is not None:
+                # we may see the same item for several tags
+                for tag in tags:
+                    if tag not in self._docs[doc][4]:
+                        self._docs[doc][4].append(tag)
+                        self._tags.setdefault(tag, set()).add(doc)
+                return False
+
+            url = self.mod_url.format(id=key) if self.mod_url and key != mod['url'] else mod['url']
+            doc = len(self._docs)
+            # same layout as on disk; (title, url, author, profile) is what `Mod.fromTuple` takes
+            self._docs.append([mod['title'], url, sys.intern(mod['author']), sys.intern(mod['profile']), list(tags)])
+            self._ids[key] = doc
+            tokens = tokenize(mod['title'])
+            self._lengths.append(len(tokens))
+            self._total_length += len(tokens)
+            for token in tokens:
+                postings = self._postings.setdefault(token, {})
+                postings[doc] = postings.get(doc, 0) + 1
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(doc)
+            self._titles.setdefault(normalize(mod['title']), []).append(doc)
+            return True
+
+    def search(self, query, tags=(), count=1, all_terms=False):
+        '''
+        Find the items best matching `query` that have all of the given `tags`.
+            :param all_terms: only return items whose title has every term of the query
+            :returns: list of item tuples (title, url, author, profile), best match first
+        '''
+        terms = tokenize(query)
+        if not terms or not self._docs:
+            return []
+
+        with self._lock:
+            return self._search(terms, normalize(query), tags, count, all_terms)
+
+    def _search(self, terms, query, tags, count, all_terms=False):
+        allowed = None
+        for tag in tags:
+            docs = self._tags.get(tag, set())
+            allowed = docs if allowed is None else allowed & docs
+        if allowed is not None and not allowed:
+            return []
+
+        total = len(self._docs)
+        average = self._total_length / total
+        scores = {}
+        matched = {}
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, frequency in postings.items():
+                if allowed is not None and doc not in allowed:
+                    continue
+                norm = frequency + _K1 * (1 - _B + _B * self._lengths[doc] / average)
+                scores[doc] = scores.get(doc, 0.0) + idf * frequency * (_K1 + 1) / norm
+                matched[doc] = matched.get(doc, 0) + 1
+
+        # prefer items matching all of the query, and exact title matches above all
+        distinct = len(set(terms))
+        if all_terms:
+            scores = {doc: score for doc, score in scores.items() if matched[doc] == distinct}
+        for doc in scores:
+            scores[doc] *= matched[doc] / distinct
+        for doc in self._titles.get(query, []):
+            if doc in scores:
+                scores[doc] += 1000
+
+        best = sorted(scores, key=lambda doc: (-scores[doc], doc))[:count]
+        return [tuple(self._docs[doc][:4]) for doc in best]
+
+    def save(self, path):
+        with self._lock:
+            state = {"version": FORMAT_VERSION, "updated": self.updated, "progress": dict(self.progress),
+                     "docs": [list(doc) for doc in self._docs]}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp = path + ".tmp"
+        with gzip.open(temp, "wt", encoding="utf-8") as index:
+            json.dump(state, index, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path, mod_url=None):
+        index = cls(mod_url)
+        with gzip.open(path, "rt", encoding="utf-8") as data:
+            state = json.load(data)
+        if state.get('version') != FORMAT_VERSION:
+            raise ValueError("unsupported index format {}".format(state.get('version')))
+        for title, url, author, profile, tags in state['docs']:
+            index.add(dict(title=title, url=url, author=author, profile=profile), tags)
+        index.updated = state['updated']
+        index.progress = state.get('progress', {})
+        return index
+
+class IndexCrawler:
+    '''
+    Keeps an index up to date by walking the workshop browse pages for each set of
+    tags, newest items first. Each round fetches new items until the first page that
+    doesn't have anything new on it. Until a set of tags has been crawled to the end
+    of its listing, each round also carries on `pages` more pages from where the last
+    one stopped; the index only counts as up to date once every listing was covered.
+    '''
+    def __init__(self, index, path, fetch, scrape, browse_url, tag_sets, pages=50, interval=6*60*60):
+        '''
+            :param fetch: function taking a url, returning the page (or None)
+            :param scrape: function taking a page, returning a list of item dicts
+            :param browse_url: function taking a list of tags and a page number, returning a url
+            :param tag_sets: list of lists of tags to crawl
+        '''
+        self.index = index
+        self.path = path
+        self.fetch = fetch
+        self.scrape = scrape
+        self.browse_url = browse_url
+        self.tag_sets = tag_sets
+        self.pages = pages
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def crawl(self):
+        '''
+        Do one round of crawling, and save the index.
+            :returns: number of new items
+        '''
+        added = 0
+        complete = True
+        for tags in self.tag_sets:
+            key = "+".join(tags)
+            resume = self.index.progress.get(key, 1)
+            end = failed = False
+            if resume != 1:
+                # the newest items, until we get to the ones we've seen
+                new, end, failed = self._walk(tags, 1, self.pages, stop_when_seen=True)
+                added += new
+            if end:
+                resume = None
+            elif resume is not None and not failed:
+                # and further back in the listing than we've been so far
+                new, end, failed = self._walk(tags, resume, resume + self.pages - 1)
+                added += new
+                if end:
+                    resume = None
+                elif not failed:
+                    resume += self.pages
+            self.index.progress[key] = resume
+            complete = complete and resume is None and not failed
+        if complete:
+            self.index.updated = time.time()
+        self.index.save(self.path)
+        log.info("crawled %s new items, index has %s items%s", added, len(self.index),
+                 "" if complete else " (not complete yet)")
+        return added
+
+    def _walk(self, tags, first, last, stop_when_seen=False):
+        # returns (new items, True if we got to the end of the listing, True if a fetch failed)
+        added = 0
+        for page in range(first, last + 1):
+            raw = self.fetch(self.browse_url(tags, page))
+            if raw is None:
+                return added, False, True
+            items = self.scrape(raw)
+            if not items:
+                return added, True, False
+            new = sum(self.index.add(item, tags) for item in items)
+            added += new
+            if stop_when_seen and not new:
+                break
+        return added, False, False
+
+    def start(self):
+        threading.Thread(target=self._run, name="index-crawler", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.crawl()
+            except Exception as exc: # pylint: disable=broad-except
+                log.exception(exc)
+            self._stopped.wait(self.interval)
+
+def browse_url(search_url, params):
+    '''
+    Returns a function creating browse page urls for `IndexCrawler`.
+        :param search_url: workshop browse url with a {params} placeholder
+        :param params: base query parameters
+    '''
+    def _url(tags, page):
+        query = dict(params)
+        query.update({"browsesort": "mostrecent", "actualsort": "mostrecent",
+                      "requiredtags[]": list(tags), "numperpage": 30, "p": page})
+        return search_url.format(params=urllib.parse.urlencode(query, True))
+    return _url
+
+if __name__ == '__main__':
+    import extractors
+
+    fixtures = sys.argv[1] if len(sys.argv) > 1 else extractors.FIXTURES
+    pages = sorted(glob.glob(os.path.join(fixtures, "*.html")))
+
+    # serve the fixture pages as if they were consecutive browse pages
+    def _fetch(url):
+        page = int(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)['p'][0])
+        if page > len(pages):
+            return b""
+        with open(pages[page - 1], "rb") as html:
+            return html.read()
+
+    target = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fixture_index.json.gz")
+    crawler = IndexCrawler(WorkshopIndex("https://steamcommunity.com/sharedfiles/filedetails/?id={id}"),
+                           target, _fetch, extractors.scrape_regex,
+                           browse_url("https://steamcommunity.com/workshop/browse/?{params}", {"appid": 294100}),
+                           [["1.0", "Mod"]], pages=len(pages) + 1)
+    crawler.crawl()
+    reloaded = WorkshopIndex.load(target)
+    print("built index of {} items from {} pages, {} bytes on disk".format(len(reloaded), len(pages), os.path.getsize(target)))
+
+    for query in ["colony manager", "Expanded Prosthetics", "RIMHUD", "vanilla expanded", "work tab", "nonexistent"]:
+        start = time.perf_counter()
+        for _ in range(1000):
+            results = reloaded.search(query, ["1.0", "Mod"], 3)
+        elapsed = (time.perf_counter() - start) * 1000
+        print("\t{} ({:.1f}us per search)".format(query, elapsed))
+        for result in results:
+            print("\t\t{0} by {2} ({1})".format(*result))
+    print("with tags [A17, Mod]: {}".format(reloaded.search("colony manager", ["0.17", "Mod"])))
@@ -2,16 +2,87 @@ import logging
 import os
 import re
 import sys
+import threading
+import time
 
-from common import EPSILON, STEAM
+from breaker import CLOSED, CircuitBreaker
+from common import CACHE, CURRENT_VERSION, EPSILON, FUZZY, HTTP, INDEX, SCRAPER, SEARCH_WORKERS, SHARED_CACHE, STEAM, STEAM_LIMITS, STREAM_FETCH
+from cache import SearchCache, cache_key, normalize
+import extractors
+from fuzzy import TitleMatcher
+import http_session
+import metrics
+from limiter import AdaptiveLimiter
 from mod import Mod
+from shared_cache import SharedCache
+from singleflight import SingleFlight
+from workshop_index import IndexCrawler, WorkshopIndex, browse_url
 from commands import ModRequest
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
-from requests import get, RequestException
-from bs4 import BeautifulSoup as bs
+from copy import copy
+from requests import RequestException
 
 log = logging.getLogger(__name__)
 
+FETCH_SECONDS = metrics.histogram("modlinker_fetch_seconds", "Time to fetch a workshop page")
+FETCH_BYTES = metrics.histogram("modlinker_fetch_bytes", "Bytes received per workshop page", metrics.SIZE_BUCKETS)
+FETCH_FAILURES = metrics.counter("modlinker_fetch_failures_total", "Failed workshop fetches")
+SCRAPE_SECONDS = metrics.histogram("modlinker_scrape_seconds", "Time to extract mods from a workshop page")
+STALE_HITS = metrics.counter("modlinker_stale_results_total", "Searches answered from stale cached results")
+DEDUPLICATED = metrics.counter("modlinker_search_deduplicated_total", "Searches that shared an identical search in flight")
+UNAVAILABLE = metrics.counter("modlinker_search_unavailable_total", "Searches we couldn't do because steam is unavailable")
+
+class SearchUnavailable(Exception):
+    '''
+    We couldn't get results from steam (and didn't have any saved); try again later.
+    '''
+
+# shared by all callers, so the cap holds for the whole bot, not just per comment
+_pool = ThreadPoolExecutor(max_workers=max(SEARCH_WORKERS, 1), thread_name_prefix="search") # pylint: disable=invalid-name
+
+# recent search results, so popular requests don't hit steam every time
+cache = SearchCache(**CACHE) # pylint: disable=invalid-name
+
+# and the ones other workers did, when running under a supervisor
+shared_cache = SharedCache(SHARED_CACHE, CACHE['ttl'], CACHE['negative_ttl'], CACHE['stale']) if SHARED_CACHE else None # pylint: disable=invalid-name
+
+# back off when steam is slow or failing, and stop trying for a while when it's down
+limiter = AdaptiveLimiter("steam", STEAM_LIMITS['initial'], STEAM_LIMITS['minimum'], # pylint: disable=invalid-name
+                          STEAM_LIMITS['maximum'], STEAM_LIMITS['target_latency'])
+breaker = CircuitBreaker("steam", **STEAM_LIMITS['breaker']) # pylint: disable=invalid-name
+
+# identical searches that come in at the same time (a popular thread, or the same
+# request twice in a comment) share a single fetch
+flights = SingleFlight("search") # pylint: disable=invalid-name
+metrics.gauge("modlinker_steam_concurrency_limit", "Concurrent workshop fetches allowed", lambda: int(limiter.limit))
+metrics.gauge("modlinker_search_waiters", "Searches waiting for an identical search in flight",
+              lambda: flights.waiting)
+metrics.gauge("modlinker_steam_breaker_open", "1 while we've stopped fetching from steam", lambda: int(breaker.state != CLOSED))
+
+# html extraction backend, see extractors
+_extract = extractors.get_backend(SCRAPER) # pylint: disable=invalid-name
+
+def _load_index():
+    try:
+        loaded = WorkshopIndex.load(INDEX['path'], STEAM['WORKSHOP']['mod_url'])
+        log.info("loaded workshop index of %s items", len(loaded))
+        return loaded
+    except FileNotFoundError:
+        log.info("no workshop index found, starting a new one")
+    except Exception as exc: # pylint: disable=broad-except
+        log.exception(exc)
+    return WorkshopIndex(STEAM['WORKSHOP']['mod_url'])
+
+# offline index of workshop items, see workshop_index
+index = _load_index() if INDEX['enabled'] else None # pylint: disable=invalid-name
+
+# known mod titles, to correct misspelled queries that steam can't find anything for, see fuzzy
+matcher = TitleMatcher(FUZZY['threshold']) if FUZZY['enabled'] else None # pylint: disable=invalid-name
+if matcher is not None and index is not None:
+    for _title in index.titles():
+        matcher.add(_title)
+
 def search(query, count=1, tags=[]):
     # start with a copy of the default parameters (really just appid and search option).
     params = STEAM['WORKSHOP']['PARAMS'].copy()
@@ -25,54 +96,307 @@ def search(query, count=1, tags=[]):
         params['requiredtags'] = tags
         query = ModRequest(True, query, "1.0", count)
 
-    # fetch matching mods (using a plain html request, since the API blows balls)
-    raw = fetch(query)
+    # steam doesn't know what to do with typos, see if we know what they meant.
+    mods = _search(query)
+    if not mods and matcher is not None:
+        corrected = correct(query)
+        if corrected is not None:
+            try:
+                mods = _search(corrected)
+            except SearchUnavailable:
+                pass
+    return mods
 
-    # scrape information from the response and instantiate mods
-    mods = [Mod(mod, query) for mod in scrape(raw)]
+def _search(query: ModRequest):
+    '''
+    Search for a single request.
+        :returns: list of Mod
+        :raises SearchUnavailable: if we couldn't get any results from steam
+    '''
+    # try the cache first
+    mods = cache.get(query)
+    if mods is not None:
+        log.info('Cache hit for %s', query)
+        return mods[0:query.count]
+
+    # then the cache shared with other workers
+    if shared_cache is not None:
+        hit = shared_cache.get(query)
+        if hit is not None:
+            items, complete, ttl = hit
+            log.info('Shared cache hit for %s', query)
+            mods = [Mod.fromTuple(item, query) for item in items]
+            cache.put(query, mods, complete=complete, ttl=ttl)
+            return mods[0:query.count]
+
+    # then the offline index, as long as it's reasonably up to date. a title sharing a word or
+    # two with the query isn't an answer though, so only trust items matching the whole query,
+    # and let steam have a go when there aren't enough of those.
+    if index is not None and not index.stale(INDEX['max_age']):
+        items = index.search(query.query, query.tags, query.count, all_terms=True)
+        if len(items) >= query.count:
+            log.info('Index hit for %s', query)
+            mods = [Mod.fromTuple(item, query) for item in items]
+            learn(mod.title for mod in mods)
+            return mods
+
+    # fetch and scrape matching mods (using a plain html request, since the API blows balls).
+    # if someone else is already fetching the same thing, wait for their results instead,
+    # unless they asked for fewer results than we want.
+    result, shared = flights.do(cache_key(query), lambda: _fetch(query),
+                                lambda result: result is None or result[1] or len(result[0]) >= query.count)
+    if shared:
+        DEDUPLICATED.inc()
+
+    # steam failed us, rather serve whatever we had before, or have the caller try again later.
+    if result is None:
+        mods = cache.get_stale(query)
+        if mods is None and shared_cache is not None:
+            hit = shared_cache.get(query, stale=True)
+            mods = [Mod.fromTuple(item, query) for item in hit[0]] if hit is not None else None
+        if mods is None:
+            UNAVAILABLE.inc()
+            raise SearchUnavailable("no results from steam for {}".format(query))
+        log.info('Serving stale results for %s', query)
+        STALE_HITS.inc()
+        return mods[0:query.count]
 
     # return x mods
+    mods, _ = result
     return mods[0:query.count]
 
+def _fetch(query: ModRequest):
+    '''
+    Fetch results for `query` from steam, and cache them.
+        :returns: (list of Mod, True if that's all there is), or None if we couldn't
+    '''
+    # don't cache failed fetches, or we'd be serving a false 'no results' for a while.
+    result = _fetch_guarded(query)
+    if result is None:
+        return None
+    items, complete = result
+    mods = [Mod(mod, query) for mod in items]
+    cache.put(query, mods, complete=complete)
+    if shared_cache is not None:
+        shared_cache.put(query, mods, complete=complete)
+    learn(mod.title for mod in mods)
+    return mods, complete
+
+def _fetch_guarded(query: ModRequest):
+    '''
+    Fetch and scrape results for `query`, within the concurrency limit, unless the breaker is open.
+        :returns: (list of mod dicts, True if that's all there is), or None if we couldn't
+    '''
+    if not limiter.acquire(STEAM_LIMITS['acquire_timeout']):
+        log.warning('Gave up waiting for a turn to search for %s', query)
+        return None
+    # only ask once we have a slot; a half-open breaker lets one trial through, which must report back
+    if not breaker.allow():
+        limiter.cancel()
+        return None
+
+    start = time.monotonic()
+    result = None
+    try:
+        if STREAM_FETCH:
+            result = fetch_stream(query)
+        else:
+            raw = fetch(query)
+            if raw is not None:
+                # steam returns at most a page worth of results, if we got less that's all there is.
+                items = scrape(raw)
+                result = items, len(items) < query.num_per_page()
+    finally:
+        limiter.release(time.monotonic() - start, result is not None)
+        if result is not None:
+            breaker.success()
+        else:
+            breaker.failure()
+    return result
+
+def correct(query: ModRequest):
+    '''
+    The request for the known title closest to a (misspelled) query, if there is one.
+        :returns: ModRequest, or None
+    '''
+    match = matcher.match(query.query)
+    if match is None:
+        return None
+    title, score = match
+    if normalize(title) == normalize(query.query):
+        return None
+    log.info('Correcting "%s" to "%s" (%.2f)', query.query, title, score)
+    corrected = copy(query)
+    corrected.query = title
+    return corrected
+
+def learn(titles):
+    if matcher is not None:
+        for title in titles:
+            matcher.add(title)
+
+def seed_matcher(titles):
+    '''
+    Teach the fuzzy matcher known titles in the background.
+        :param titles: function returning an iterable of titles, e.g. `database.known_titles`
+    '''
+    def _seed():
+        try:
+            known = list(titles())
+            learn(known)
+            log.info("fuzzy matcher knows %s titles", len(matcher))
+        except Exception as exc: # pylint: disable=broad-except
+            log.exception(exc)
+    if matcher is not None:
+        threading.Thread(target=_seed, name="fuzzy-seed", daemon=True).start()
+
+def search_all(requests, wrap=None):
+    '''
+    Search for a list of requests (e.g. from `ModRequest.fromPost`) concurrently,
+    on a bounded pool of worker threads. Results are returned in request order.
+        :param requests: list of ModRequest
+        :param wrap: function wrapping the searches run on the pool, e.g. `Profiler.wrap`
+    '''
+    requests = list(requests)
+    if len(requests) <= 1 or SEARCH_WORKERS <= 1:
+        return [search(request) for request in requests]
+    return list(_pool.map(wrap(search) if wrap is not None else search, requests))
+
+def start_crawler():
+    '''
+    Start keeping the offline index up to date in the background.
+    '''
+    tag_sets = [[version, kind] for version in INDEX['versions'] or [CURRENT_VERSION] for kind in ("Mod", "Scenario")]
+    crawler = IndexCrawler(index, INDEX['path'], fetch_url, scrape,
+                           browse_url(STEAM['WORKSHOP']['search_url'], STEAM['WORKSHOP']['PARAMS']),
+                           tag_sets, INDEX['pages'], INDEX['crawl_interval'])
+    crawler.start()
+    return crawler
+
+def follow_index(interval=60):
+    '''
+    Reload the offline index whenever another process that crawls (see `start_crawler`) saves a new one.
+        :param interval: seconds between checks
+    '''
+    def _mtime():
+        try:
+            return os.path.getmtime(INDEX['path'])
+        except OSError:
+            return None
+
+    def _follow(loaded):
+        global index # pylint: disable=global-statement,invalid-name
+        while True:
+            time.sleep(interval)
+            changed = _mtime()
+            if changed is None or changed == loaded:
+                continue
+            try:
+                fresh = WorkshopIndex.load(INDEX['path'], STEAM['WORKSHOP']['mod_url'])
+            except Exception as exc: # pylint: disable=broad-except
+                log.exception(exc)
+                continue
+            loaded = changed
+            learn(fresh.titles())
+            index = fresh
+            log.info("reloaded workshop index of %s items", len(fresh))
+    threading.Thread(target=_follow, args=(_mtime(),), name="index-follower", daemon=True).start()
+
 def fetch(query: ModRequest):
-    url = query.get_url()
+    return fetch_url(query.get_url())
+
+def fetch_url(url):
+    start = time.perf_counter()
     try:
         log.info('Fetching %s...', url)
-        with get(url) as response:
+        with http_session.get(url) as response:
             try:
                 if (response.status_code == 200
                         and response.headers['Content-Type'] is not None
                         and response.headers['Content-Type'].lower().find('html') > -1):
-                    return response.content
+                    content = response.content
+                    FETCH_SECONDS.observe(time.perf_counter() - start)
+                    FETCH_BYTES.observe(len(content))
+                    return content
+                log.warning('Fetching %s failed: %s %s', url, response.status_code, response.reason)
             except Exception as exc:
                 log.exception(exc)
-                return None
             finally:
                 response.close()
 
     except RequestException as exc:
         log.exception(exc)
+    FETCH_FAILURES.inc()
+    return None
+
+def fetch_stream(query: ModRequest):
+    '''
+    Stream the search results for `query`, extracting workshop items as they come in.
+    The connection is closed as soon as we have `query.count` items.
+        :returns: (list of mod dicts, True if we saw the whole page), or None if the fetch failed.
+    '''
+    url = query.get_url()
+    start = time.monotonic()
+    first_item = None
+    scraping = 0.0
+    extractor = extractors.ItemExtractor()
+    items = []
+    try:
+        log.info('Streaming %s...', url)
+        with http_session.get(url, stream=True) as response:
+            if (response.status_code != 200
+                    or response.headers.get('Content-Type', '').lower().find('html') < 0):
+                log.warning('Fetching %s failed: %s %s', url, response.status_code, response.reason)
+                FETCH_FAILURES.inc()
+                return None
+
+            complete = True
+            for chunk in response.iter_content(chunk_size=HTTP['chunk_size']):
+                started = time.perf_counter()
+                items += extractor.feed(chunk)
+                scraping += time.perf_counter() - started
+                if items and first_item is None:
+                    first_item = time.monotonic() - start
+                if len(items) >= query.count:
+                    complete = False
+                    break
+            else:
+                items += extractor.close()
+
+            # bytes on the wire, before decompression
+            received = response.raw.tell()
+
+    except RequestException as exc:
+        log.exception(exc)
+        FETCH_FAILURES.inc()
         return None
 
+    FETCH_SECONDS.observe(time.monotonic() - start)
+    FETCH_BYTES.observe(received)
+    SCRAPE_SECONDS.observe(scraping)
+
+    log.info('Got %s items for %s in %.0fms (%s bytes%s)', len(items), query,
+             (time.monotonic() - start) * 1000, received,
+             ", first item after {:.0f}ms".format(first_item * 1000) if first_item is not None else "")
+    return items, complete
+
 def scrape(html: str):
-    mods = []
+    if html is None:
+        return []
     try:
-        soup = bs(html, features="html.parser")
-        for _mod in soup.select("div.workshopItem"):
-            title_ele = _mod.select_one("div.workshopItemTitle")
-            author_ele = _mod.select_one("div.workshopItemAuthorName")
-            mod = dict(
-                title=title_ele.string, 
-                url=title_ele.parent['href'],
-                author=author_ele.a.string,
-                profile=author_ele.a['href'])
-            mods.append(mod)
-
-    except Exception as exc:
+        with SCRAPE_SECONDS.time():
+            return _extract(html)
+    except Exception as exc: # pylint: disable=broad-except
         log.exception(exc)
 
-    finally:
-        return mods
+    # the fast backends may choke on unexpected markup, BeautifulSoup is more forgiving.
+    if _extract is extractors.scrape_soup:
+        return []
+    try:
+        return extractors.scrape_soup(html)
+    except Exception as exc: # pylint: disable=broad-except
+        log.exception(exc)
+        return []
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(module)s :: %(levelname)s :: %(message)s', level=logging.INFO)
@@ -23,8 +23,12 @@ DB.prototype.connect = function( callback ){
     })
 }
 
+// total of the daily counters, so requests that were archived still count
 DB.prototype.count = function(){
-    return this.db.collection( "requests_collection" ).count();
+    return this.db.collection( "counts_daily" )
+        .aggregate([ { $group: { _id: null, count: { $sum: "$count" } } } ])
+        .toArray()
+        .then( docs => docs.length ? docs[0].count : 0 )
 }
 
 DB.prototype.latestLinks = function( limit = 10 ){
@@ -35,23 +39,17 @@ DB.prototype.latestLinks = function( limit = 10 ){
         .toArray()
 }
 
+// counters are kept up to date by the bot, see bot/database.py
+DB.prototype.top = function( collection, limit ){
+    return this.db.collection( collection )
+        .find({})
+        .sort({'count': -1})
+        .limit( limit )
+        .toArray()
+}
+
 DB.prototype.topMods = function( limit = 10, table = true ){
-    return this.db.collection( "requests_collection" ).aggregate([
-        {
-            $group: {
-              _id: "$mod.title",
-              count: { $sum: 1 },
-              url: { $first: "$mod.url" },
-              author: { $first: "$mod.author" },
-            }
-        }, 
-        { 
-           $sort: { count: -1 }
-        },
-        {
-            $limit: limit
-        }
-    ]).toArray()
+    return this.top( "counts_mods", limit )
       .then( docs => {
             if (table){
                 let table = {
@@ -74,21 +72,7 @@ DB.prototype.topMods = function( limit = 10, table = true ){
 }
 
 DB.prototype.topAuthors = function( limit = 10, table = true ){
-    return this.db.collection( "requests_collection" ).aggregate([
-        {
-            $group: {
-              _id: "$mod.author",
-              count: { $sum: 1 },
-              url: { $first: "$mod.authorUrl" },
-            }
-        }, 
-        { 
-           $sort: { count: -1 }
-        },
-        {
-            $limit: limit
-        }
-    ]).toArray()
+    return this.top( "counts_authors", limit )
         .then( docs => {
           if (table){
               let table = {
@@ -110,20 +94,7 @@ DB.prototype.topAuthors = function( limit = 10, table = true ){
 }
 
 DB.prototype.topRequesters = function( limit = 10, table = true ){
-    return this.db.collection( "requests_collection" ).aggregate([
-        {
-            $group: {
-              _id: "$requestingRedditor",
-              count: { $sum: 1 }
-            }
-        }, 
-        { 
-           $sort: { count: -1 }
-        },
-        {
-            $limit: limit
-        }
-    ]).toArray()
+    return this.top( "counts_redditors", limit )
         .then( docs => {
         if (table){
             let table = {